@@ -2,17 +2,24 @@ from dotenv import load_dotenv
 
 from .main import (
     create_memory,
+    create_memories,
     create_unique_memory,
     get_memories,
+    iter_memories,
     search_memory,
+    search_memories,
+    search_memory_by_embedding,
+    search_similar_to,
     get_memory,
     update_memory,
+    update_memories,
     delete_memory,
     delete_memories,
     delete_similar_memories,
     count_memories,
     wipe_category,
     wipe_all_memories,
+    transaction,
 )
 
 from .events import (
@@ -45,23 +52,30 @@ from .clustering import (
     cluster,
 )
 
-from .check_model import check_model, infer_embeddings
+from .check_model import check_model, infer_embeddings, get_embedding_engine
 
 load_dotenv()
 
 __all__ = [
     "create_memory",
+    "create_memories",
     "create_unique_memory",
     "get_memories",
+    "iter_memories",
     "search_memory",
+    "search_memories",
+    "search_memory_by_embedding",
+    "search_similar_to",
     "get_memory",
     "update_memory",
+    "update_memories",
     "delete_memory",
     "delete_memories",
     "delete_similar_memories",
     "count_memories",
     "wipe_category",
     "wipe_all_memories",
+    "transaction",
     "chroma_collection_to_list",
     "list_to_chroma_collection",
     "export_memory_to_json",
@@ -80,4 +94,5 @@ __all__ = [
     "cluster",
     "check_model",
     "infer_embeddings",
+    "get_embedding_engine",
 ]
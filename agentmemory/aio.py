@@ -0,0 +1,78 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from agentmemory import main
+
+# embedding inference and database calls block, so they run on a bounded pool of threads
+# instead of the event loop. The default matches the Postgres connection pool.
+executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("AIO_MAX_WORKERS", 10)),
+    thread_name_prefix="agentmemory",
+)
+
+
+async def run(function, *args, **kwargs):
+    """
+    Run a blocking function on the agentmemory executor and wait for its result.
+
+    Example:
+    >>> count = await run(count_memories, "books")
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor, functools.partial(function, *args, **kwargs)
+    )
+
+
+async def create_memory(category, text, metadata=None, embedding=None, id=None):
+    """
+    Awaitable create_memory. The metadata is copied, since the worker thread
+    adds timestamps to it while the caller's coroutine keeps running.
+
+    Example:
+    >>> await create_memory('sample_category', 'sample_text', metadata={'sample_key': 'sample_value'})
+    """
+    metadata = dict(metadata or {})
+    return await run(main.create_memory, category, text, metadata, embedding, id)
+
+
+async def search_memory(category, search_text, **kwargs):
+    """
+    Awaitable search_memory, takes the same keyword arguments.
+
+    Example:
+    >>> await search_memory('sample_category', 'search_text', n_results=5)
+    """
+    return await run(main.search_memory, category, search_text, **kwargs)
+
+
+async def get_memories(category, **kwargs):
+    """
+    Awaitable get_memories, takes the same keyword arguments.
+
+    Example:
+    >>> await get_memories("books", sort_order="asc", n_results=10)
+    """
+    return await run(main.get_memories, category, **kwargs)
+
+
+async def update_memory(category, id, text=None, metadata=None, embedding=None):
+    """
+    Awaitable update_memory.
+
+    Example:
+    >>> await update_memory("books", "1", text="New text", metadata={"author": "New author"})
+    """
+    return await run(main.update_memory, category, id, text, metadata, embedding)
+
+
+async def delete_memory(category, id):
+    """
+    Awaitable delete_memory.
+
+    Example:
+    >>> await delete_memory("books", "1")
+    """
+    return await run(main.delete_memory, category, id)
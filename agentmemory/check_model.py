@@ -36,39 +36,411 @@ def check_model(model_name = "all-MiniLM-L6-v2", model_path = default_model_path
     return str(DOWNLOAD_PATH / "onnx")
 
 import importlib
+import queue
+import threading
+import time
+import uuid
+import weakref
+from concurrent.futures import Future, TimeoutError
+from dataclasses import dataclass
 import numpy as np
 from tokenizers import Tokenizer
 import onnxruntime
 import numpy.typing as npt
 from typing import List
 
+from .embedding_cache import DEFAULT_MAX_BYTES, EmbeddingCache
+
+PERSIST_OPTIMIZED_MODEL = (
+    os.getenv("PERSIST_OPTIMIZED_MODEL", "false") == "true"
+    or os.getenv("PERSIST_OPTIMIZED_MODEL", "false") == "True"
+)
+
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH")
+EMBEDDING_CACHE_MAX_BYTES = int(
+    os.getenv("EMBEDDING_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)
+)
+
+EMBEDDING_SCHEDULER = (
+    os.getenv("EMBEDDING_SCHEDULER", "false") == "true"
+    or os.getenv("EMBEDDING_SCHEDULER", "false") == "True"
+)
+EMBEDDING_SCHEDULER_BATCH_SIZE = int(os.getenv("EMBEDDING_SCHEDULER_BATCH_SIZE", 32))
+EMBEDDING_SCHEDULER_MAX_WAIT_MS = float(os.getenv("EMBEDDING_SCHEDULER_MAX_WAIT_MS", 2))
+
+OPTIMIZED_MODEL_FILENAME = "model.optimized.onnx"
+
+MAX_SEQUENCE_LENGTH = 256
+
+
+@dataclass
+class EmbeddingModel:
+    tokenizer: Tokenizer
+    session: onnxruntime.InferenceSession
+
+
+class EmbeddingEngine:
+    """
+    Holds a warm tokenizer and ONNX inference session for each model path, so
+    the model is only loaded once per process.
+
+    Arguments:
+    persist_optimized (bool): Save the optimized ONNX graph next to the model
+        the first time it is loaded, and load that graph on later process starts.
+    cache_path (str): Directory of the on-disk embedding cache. Embeddings are
+        not cached if this is None.
+    cache_max_bytes (int): Size budget of the embedding cache for each model.
+    schedule (bool): Batch the requests of concurrent callers with an EmbeddingScheduler.
+    schedule_batch_size (int): Number of documents that makes the scheduler run a batch at once.
+    schedule_max_wait (float): Seconds the scheduler waits for more requests before running a batch.
+    """
+
+    def __init__(
+        self,
+        persist_optimized=PERSIST_OPTIMIZED_MODEL,
+        cache_path=EMBEDDING_CACHE_PATH,
+        cache_max_bytes=EMBEDDING_CACHE_MAX_BYTES,
+        schedule=EMBEDDING_SCHEDULER,
+        schedule_batch_size=EMBEDDING_SCHEDULER_BATCH_SIZE,
+        schedule_max_wait=EMBEDDING_SCHEDULER_MAX_WAIT_MS / 1000,
+    ):
+        self.persist_optimized = persist_optimized
+        self.cache_path = cache_path
+        self.cache_max_bytes = cache_max_bytes
+        self.schedule = schedule
+        self.schedule_batch_size = schedule_batch_size
+        self.schedule_max_wait = schedule_max_wait
+        self.models = {}
+        self.caches = {}
+        self.schedulers = {}
+        self.lock = threading.Lock()
+
+    def load(self, model_path: str) -> EmbeddingModel:
+        model = self.models.get(model_path)
+        if model is not None:
+            return model
+
+        with self.lock:
+            # another thread may have loaded the model while we waited
+            model = self.models.get(model_path)
+            if model is None:
+                model = EmbeddingModel(
+                    tokenizer=self._load_tokenizer(model_path),
+                    session=self._load_session(model_path),
+                )
+                self.models[model_path] = model
+        return model
+
+    def get_cache(self, model_path: str) -> EmbeddingCache:
+        if self.cache_path is None:
+            return None
+
+        cache = self.caches.get(model_path)
+        if cache is not None:
+            return cache
+
+        with self.lock:
+            cache = self.caches.get(model_path)
+            if cache is None:
+                cache = EmbeddingCache(
+                    self.cache_path,
+                    model_name=_model_name(model_path),
+                    max_bytes=self.cache_max_bytes,
+                )
+                self.caches[model_path] = cache
+        return cache
+
+    def get_scheduler(self, model_path: str) -> "EmbeddingScheduler":
+        if not self.schedule:
+            return None
+
+        scheduler = self.schedulers.get(model_path)
+        if scheduler is not None:
+            return scheduler
+
+        with self.lock:
+            scheduler = self.schedulers.get(model_path)
+            if scheduler is None:
+                scheduler = EmbeddingScheduler(
+                    model_path,
+                    max_batch_size=self.schedule_batch_size,
+                    max_wait=self.schedule_max_wait,
+                    engine=self,
+                )
+                self.schedulers[model_path] = scheduler
+        return scheduler
+
+    def warmup(self, model_path: str) -> None:
+        """
+        Load the model for model_path and run a single inference, so the first
+        real request does not pay for loading or memory allocation.
+        """
+        infer_embeddings(["warmup"], model_path, engine=self, use_cache=False)
+
+    def unload(self, model_path: str = None) -> None:
+        with self.lock:
+            if model_path is None:
+                self.models.clear()
+            else:
+                self.models.pop(model_path, None)
+
+    def _load_tokenizer(self, model_path):
+        tokenizer = Tokenizer.from_file(model_path + "/tokenizer.json")
+        # padding is applied per batch in infer_embeddings
+        tokenizer.enable_truncation(max_length=MAX_SEQUENCE_LENGTH)
+        tokenizer.no_padding()
+        return tokenizer
+
+    def _load_session(self, model_path):
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        model_file = model_path + "/model.onnx"
+
+        if not self.persist_optimized:
+            return onnxruntime.InferenceSession(model_file, options)
+
+        optimized_file = os.path.join(model_path, OPTIMIZED_MODEL_FILENAME)
+        if os.path.exists(optimized_file):
+            # the graph was optimized by an earlier process, skip doing it again
+            options.graph_optimization_level = (
+                onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+            )
+            return onnxruntime.InferenceSession(optimized_file, options)
+
+        # extended optimizations are portable across machines, unlike ORT_ENABLE_ALL
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+        )
+        # write to a temporary file first so concurrent processes never read a partial graph
+        temp_file = f"{optimized_file}.{uuid.uuid4().hex}.tmp"
+        options.optimized_model_filepath = temp_file
+        session = onnxruntime.InferenceSession(model_file, options)
+        if os.path.exists(temp_file):
+            os.replace(temp_file, optimized_file)
+        return session
+
+
+def _model_name(model_path):
+    # check_model returns <model_path>/<model_name>/onnx
+    path = Path(model_path)
+    return path.parent.name if path.name == "onnx" else path.name
+
+
+embedding_engine = None
+
+
+def get_embedding_engine() -> EmbeddingEngine:
+    global embedding_engine
+    if embedding_engine is None:
+        embedding_engine = EmbeddingEngine()
+    return embedding_engine
+
+
 def _normalize(v: npt.NDArray) -> npt.NDArray:
     norm = np.linalg.norm(v, axis=1)
     norm[norm == 0] = 1e-12
     return v / norm[:, np.newaxis]
 
-def infer_embeddings(documents: List[str], model_path: str, batch_size: int = 32) -> npt.NDArray:
-    # Load the tokenizer and model
-    tokenizer = Tokenizer.from_file(model_path + "/tokenizer.json")
-    tokenizer.enable_truncation(max_length=256)
-    tokenizer.enable_padding(pad_id=0, pad_token="[PAD]", length=256)
-    model = onnxruntime.InferenceSession(model_path + "/model.onnx")
+def infer_embeddings(
+    documents: List[str],
+    model_path: str,
+    batch_size: int = 32,
+    engine: EmbeddingEngine = None,
+    padding: str = "longest",
+    use_cache: bool = True,
+) -> npt.NDArray:
+    """
+    Embed documents with the ONNX model at model_path.
+
+    Arguments:
+    documents (list): Texts to embed.
+    model_path (str): Path to the extracted ONNX model, as returned by check_model.
+    batch_size (int): Number of documents passed to the model at once.
+    engine (EmbeddingEngine): Engine holding the loaded model. Defaults to the process-wide engine.
+    padding (str): "longest" sorts documents by token length and pads each batch to its
+        longest document. "max_length" pads every document to 256 tokens.
+    use_cache (bool): Look documents up in the engine's embedding cache, if it has one,
+        and only run the model for the ones that are missing.
+
+    Returns:
+    ndarray: Normalized float32 embeddings, one row per document, in input order.
+    """
+    if padding not in ("longest", "max_length"):
+        raise ValueError(f"Unknown padding: {padding}")
+
+    engine = engine or get_embedding_engine()
+    documents = list(documents)
+
+    cache = engine.get_cache(model_path) if use_cache else None
+    if cache is None or len(documents) == 0:
+        return _run_model(engine.load(model_path), documents, batch_size, padding)
+
+    cached = cache.get_many(documents)
+    missing = [index for index, embedding in enumerate(cached) if embedding is None]
+    if len(missing) == len(documents):
+        embeddings = _run_model(engine.load(model_path), documents, batch_size, padding)
+        cache.put_many(documents, embeddings)
+        return embeddings
+
+    if len(missing) > 0:
+        missing_documents = [documents[index] for index in missing]
+        computed = _run_model(engine.load(model_path), missing_documents, batch_size, padding)
+        cache.put_many(missing_documents, computed)
+        for index, embedding in zip(missing, computed):
+            cached[index] = embedding
+
+    return np.stack(cached).astype(np.float32)
+
+
+def embed_documents(documents: List[str], model_path: str, engine: EmbeddingEngine = None) -> npt.NDArray:
+    """
+    Embed documents through the engine's scheduler if it has one, so concurrent callers
+    share model runs, and with infer_embeddings otherwise.
+    """
+    engine = engine or get_embedding_engine()
+    scheduler = engine.get_scheduler(model_path)
+    if scheduler is None:
+        return infer_embeddings(documents, model_path, engine=engine)
+    return scheduler.embed(documents)
+
+
+# schedulers whose worker thread has to be started again in a forked child
+schedulers = weakref.WeakSet()
+
+
+def _reset_schedulers():
+    for scheduler in list(schedulers):
+        scheduler._reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_schedulers)
+
+
+class EmbeddingScheduler:
+    """
+    Queues embedding requests from concurrent callers and runs them through the
+    model together. A batch runs once it holds max_batch_size documents, or
+    max_wait seconds after its first request arrived, and each caller's future
+    gets back the rows of its own documents.
+
+    Arguments:
+    model_path (str): Path to the extracted ONNX model, as returned by check_model.
+    max_batch_size (int): Number of documents that makes a batch run at once.
+    max_wait (float): Seconds a batch waits for more requests.
+    engine (EmbeddingEngine): Engine holding the loaded model. Defaults to the process-wide engine.
+    """
+
+    # seconds embed waits before checking that the worker is still running
+    poll_interval = 1.0
+
+    def __init__(self, model_path, max_batch_size=32, max_wait=0.002, engine=None):
+        self.model_path = model_path
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.engine = engine
+        self.batches = 0
+        self._reset()
+        schedulers.add(self)
+
+    def _reset(self):
+        # a forked child has none of the parent's threads, nor its waiting callers
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def _ensure_worker(self):
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(
+                    target=self._work, name="agentmemory-embeddings", daemon=True
+                )
+                self.worker.start()
+
+    def submit(self, documents: List[str]) -> Future:
+        future = Future()
+        self.requests.put((list(documents), future))
+        self._ensure_worker()
+        return future
+
+    def embed(self, documents: List[str]) -> npt.NDArray:
+        future = self.submit(documents)
+        while True:
+            try:
+                return future.result(timeout=self.poll_interval)
+            except TimeoutError:
+                # queued requests are picked up again if the worker stopped
+                self._ensure_worker()
+
+    def _work(self):
+        while True:
+            batch = [self.requests.get()]
+            size = len(batch[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while size < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request[0])
+            try:
+                self._run(batch)
+            except BaseException as error:
+                # every taken request gets an answer, and the worker keeps serving the queue
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+
+    def _run(self, batch):
+        # cancelled requests are dropped, the others can no longer be cancelled
+        batch = [(documents, future) for documents, future in batch if future.set_running_or_notify_cancel()]
+        if len(batch) == 0:
+            return
+        documents = [document for documents, _ in batch for document in documents]
+        embeddings = infer_embeddings(documents, self.model_path, engine=self.engine)
+        self.batches += 1
+
+        start = 0
+        for documents, future in batch:
+            future.set_result(embeddings[start : start + len(documents)])
+            start += len(documents)
+
+
+def _run_model(model: EmbeddingModel, documents, batch_size, padding) -> npt.NDArray:
+    encoded = model.tokenizer.encode_batch(documents)
+    lengths = np.array([len(e.ids) for e in encoded], dtype=np.int64)
+
+    if padding == "longest":
+        # bucket documents of similar length together so little padding is needed
+        order = np.argsort(lengths, kind="stable")
+    else:
+        order = np.arange(len(encoded))
 
     all_embeddings = []
-    for i in range(0, len(documents), batch_size):
-        batch = documents[i : i + batch_size]
-        encoded = [tokenizer.encode(d) for d in batch]
-        input_ids = np.array([e.ids for e in encoded])
-        attention_mask = np.array([e.attention_mask for e in encoded])
+    for i in range(0, len(order), batch_size):
+        batch = order[i : i + batch_size]
+        if padding == "longest":
+            width = max(int(lengths[batch].max()), 1)
+        else:
+            width = MAX_SEQUENCE_LENGTH
+        input_ids = np.zeros((len(batch), width), dtype=np.int64)
+        attention_mask = np.zeros((len(batch), width), dtype=np.int64)
+        for row, index in enumerate(batch):
+            ids = encoded[index].ids
+            input_ids[row, : len(ids)] = ids
+            attention_mask[row, : len(ids)] = 1
         onnx_input = {
-            "input_ids": np.array(input_ids, dtype=np.int64),
-            "attention_mask": np.array(attention_mask, dtype=np.int64),
-            "token_type_ids": np.array(
-                [np.zeros(len(e), dtype=np.int64) for e in input_ids],
-                dtype=np.int64,
-            ),
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "token_type_ids": np.zeros_like(input_ids),
         }
-        model_output = model.run(None, onnx_input)
+        model_output = model.session.run(None, onnx_input)
         last_hidden_state = model_output[0]
         # Perform mean pooling with attention weighting
         input_mask_expanded = np.broadcast_to(
@@ -79,4 +451,13 @@ def infer_embeddings(documents: List[str], model_path: str, batch_size: int = 32
         )
         embeddings = _normalize(embeddings).astype(np.float32)
         all_embeddings.append(embeddings)
-    return np.concatenate(all_embeddings)
+
+    if len(all_embeddings) == 0:
+        width = model.session.get_outputs()[0].shape[-1]
+        return np.zeros((0, width if isinstance(width, int) else 0), dtype=np.float32)
+
+    # put the embeddings back in the order the documents were given
+    sorted_embeddings = np.concatenate(all_embeddings)
+    result = np.empty_like(sorted_embeddings)
+    result[order] = sorted_embeddings
+    return result
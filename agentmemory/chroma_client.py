@@ -1,18 +1,142 @@
 import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
 
 import chromadb
 
-from .client import CollectionMemory, AgentMemory
+from .check_model import check_model, embed_documents
+from .client import CollectionMemory, AgentMemory, CollectionRegistry
+
+
+class ChromaEmbeddingFunction:
+    """
+    Embeds documents for chroma with agentmemory's embedding engine, so chroma
+    shares the warm model and the embedding cache with the rest of the package.
+    Uses the same model as chroma's default embedding function.
+    """
+
+    def __init__(self, model_name="all-MiniLM-L6-v2"):
+        self.model_name = model_name
+        self.model_path = None
+
+    def __call__(self, input):
+        return self.embed(input).tolist()
+
+    def embed(self, input):
+        if self.model_path is None:
+            self.model_path = check_model(model_name=self.model_name)
+        return embed_documents(list(input), model_path=self.model_path)
+
 
 class ChromaCollectionMemory(CollectionMemory):
-    def __init__(self, collection, metadata=None) -> None:
+    def __init__(self, collection, metadata=None, max_batch_size=None, batches=None) -> None:
         self.collection = collection
+        self.id_lock = threading.Lock()
+        # generated ids below this one are taken, even if their memories are not written yet
+        self.next_id = 0
+        # per-thread buffers of the client's open batches
+        self.batches = batches
+        if max_batch_size is not None:
+            self.max_batch_size = max_batch_size
+
+    def _pending(self):
+        """
+        Writes buffered by the current thread's batch, or None outside a batch.
+        """
+        pending = getattr(self.batches, "pending", None)
+        if pending is None:
+            return None
+        return pending.setdefault(self, [])
+
+    def _flush(self):
+        # send buffered writes before anything that reads or changes the collection
+        pending = getattr(self.batches, "pending", None)
+        if pending:
+            self._write(pending.pop(self, []))
+
+    def _write(self, calls):
+        """
+        Send buffered add and upsert calls, merging consecutive calls of the same shape.
+        """
+        runs = []
+        for call in calls:
+            shape = tuple(
+                call[key] is None for key in ("documents", "metadatas", "embeddings")
+            ) + (call["op"],)
+            if runs and runs[-1][0] == shape:
+                runs[-1][1].append(call)
+            else:
+                runs.append((shape, [call]))
 
-    def count(self):
-        return self.collection.count()
+        with self._count_change():
+            for shape, run in runs:
+                merged = {
+                    key: None
+                    if run[0][key] is None
+                    else [value for call in run for value in call[key]]
+                    for key in ("ids", "documents", "metadatas", "embeddings")
+                }
+                write = getattr(self.collection, run[0]["op"])
+                for start in range(0, len(merged["ids"]), self.max_batch_size):
+                    end = start + self.max_batch_size
+                    chunk = {
+                        key: None if values is None else values[start:end]
+                        for key, values in merged.items()
+                    }
+                    write(**chunk)
+
+            if all(call["new"] for call in calls):
+                self._adjust_count(sum(len(call["ids"]) for call in calls))
+            else:
+                # some of the ids may already have existed
+                self._invalidate_count()
+
+    def _reserve_ids(self, size):
+        """
+        Generate size ids that sort in creation order and reserve them, so no other
+        write is given the same ids while these are buffered or being written.
+        """
+        with self.id_lock:
+            # microseconds since the epoch, 16 digits, so new ids sort after older ones
+            # without reading the collection, even after deletes or a restart
+            origin = max(time.time_ns() // 1000, self.next_id)
+            self.next_id = origin + size
+        # another process can number its ids the same way, the suffix keeps them apart
+        suffix = uuid.uuid4().hex[:8]
+        return [f"{id_:016d}{suffix}" for id_ in range(origin, origin + size)]
+
+    def count(self, where=None):
+        self._flush()
+        if where is not None:
+            # only fetch the ids of the matching records
+            return len(self.collection.get(where=where, include=[])["ids"])
+
+        return self._cached_count(self.collection.count)
 
     def add(self, ids, documents=None, metadatas=None, embeddings=None):
-        return self.collection.add(ids, documents, metadatas, embeddings)
+        pending = self._pending()
+        if pending is not None:
+            pending.append(
+                {
+                    "op": "add",
+                    "ids": list(ids),
+                    "documents": documents,
+                    "metadatas": metadatas,
+                    "embeddings": embeddings,
+                    "new": True,
+                    "generated": False,
+                }
+            )
+            return None
+
+        with self._count_change():
+            result = self.collection.add(
+                ids=ids, embeddings=embeddings, metadatas=metadatas, documents=documents
+            )
+            self._adjust_count(len(ids))
+        return result
 
     def get(
         self,
@@ -22,10 +146,85 @@ class ChromaCollectionMemory(CollectionMemory):
         offset=None,
         where_document=None,
         include=["metadatas", "documents"],
+        order=None,
+        after=None,
     ):
-        return self.collection.get(ids, where, limit, offset, where_document, include)
+        self._flush()
+        if order is None and after is None:
+            return self.collection.get(ids, where, limit, offset, where_document, include)
+
+        # chroma can't sort, so sort the matching ids and only fetch the records on the page
+        matching = self._sorted_ids(ids, where, where_document, order, after)
+        start = offset or 0
+        end = start + limit if limit is not None else None
+        return self._get_in_order(matching[start:end], include)
+
+    def stream(
+        self,
+        where=None,
+        where_document=None,
+        include=["metadatas", "documents"],
+        order="asc",
+        page_size=100,
+    ):
+        self._flush()
+        if order is None:
+            # chroma's own order needs no id list, pages are read by offset
+            start = 0
+            while True:
+                page = self.collection.get(
+                    where=where,
+                    where_document=where_document,
+                    limit=page_size,
+                    offset=start,
+                    include=include,
+                )
+                if len(page["ids"]) == 0:
+                    return
+                yield page
+                if len(page["ids"]) < page_size:
+                    return
+                start += page_size
+
+        # chroma can't sort, so the matching ids are sorted once, then the records are fetched a page at a time
+        matching = self._sorted_ids(None, where, where_document, order, None)
+        for start in range(0, len(matching), page_size):
+            yield self._get_in_order(matching[start : start + page_size], include)
+
+    def _sorted_ids(self, ids, where, where_document, order, after):
+        matching = self.collection.get(
+            ids, where, where_document=where_document, include=[]
+        )["ids"]
+        matching.sort(reverse=order == "desc")
+        if after is not None:
+            after = str(after)
+            if order == "desc":
+                matching = [id_ for id_ in matching if id_ < after]
+            else:
+                matching = [id_ for id_ in matching if id_ > after]
+        return matching
+
+    def _get_in_order(self, ids, include):
+        if len(ids) == 0:
+            return {
+                "ids": [],
+                "documents": [] if "documents" in include else None,
+                "metadatas": [] if "metadatas" in include else None,
+                "embeddings": [] if "embeddings" in include else None,
+            }
+
+        result = self.collection.get(ids=ids, include=include)
+
+        # chroma doesn't return records in the order the ids were given
+        position = {id_: index for index, id_ in enumerate(result["ids"])}
+        order = [position[id_] for id_ in ids if id_ in position]
+        for key, values in result.items():
+            if isinstance(values, list) and len(values) == len(order):
+                result[key] = [values[index] for index in order]
+        return result
 
     def peek(self, limit=10):
+        self._flush()
         return self.collection.peek(limit)
 
     def query(
@@ -37,42 +236,142 @@ class ChromaCollectionMemory(CollectionMemory):
         where_document=None,
         include=["metadatas", "documents", "distances"],
     ):
+        self._flush()
         return self.collection.query(query_embeddings, query_texts, n_results, where, where_document, include)
 
     def update(self, ids, documents=None, metadatas=None, embeddings=None):
+        self._flush()
+        if documents is not None and any(document is None for document in documents):
+            # memories given no new text keep their stored one
+            stored = self.collection.get(ids=list(ids), include=["documents"])
+            stored = dict(zip(stored["ids"], stored["documents"]))
+            documents = [
+                stored.get(id_) if document is None else document
+                for id_, document in zip(ids, documents)
+            ]
         return self.collection.update(ids, embeddings, metadatas, documents)
 
     def upsert(self, ids, documents=None, metadatas=None, embeddings=None):
-        # if no id is provided, generate one based on count of documents in collection
-        if any(id is None for id in ids):
-            origin = self.count()
-            # pad the id with zeros to make it 16 digits long
-            ids = [str(id_).zfill(16) for id_ in range(origin, origin+len(documents))]
+        """
+        Returns the ids that were written, generated ones included, also while they are buffered.
+        """
+        # if no id is provided, generate ones that sort in creation order
+        generated = any(id is None for id in ids)
+        pending = self._pending()
+        if pending is not None:
+            if generated:
+                ids = self._reserve_ids(len(documents))
+            pending.append(
+                {
+                    "op": "upsert",
+                    "ids": list(ids),
+                    "documents": documents,
+                    "metadatas": metadatas,
+                    "embeddings": embeddings,
+                    # generated ids are always new
+                    "new": generated,
+                    "generated": generated,
+                }
+            )
+            return list(ids)
+
+        if generated:
+            # threads generating ids from the same count would overwrite each other
+            ids = self._reserve_ids(len(documents))
+            with self._count_change():
+                self.collection.upsert(ids, embeddings, metadatas, documents)
+                self._adjust_count(len(ids))
+            return ids
 
-        return self.collection.upsert(ids, embeddings, metadatas, documents)
+        self.collection.upsert(ids, embeddings, metadatas, documents)
+        # some of the ids may already have existed
+        self._invalidate_count()
+        return list(ids)
 
     def delete(self, ids=None, where=None, where_document=None):
-        return self.collection.delete(ids, where, where_document)
+        self._flush()
+        result = self.collection.delete(ids, where, where_document)
+        self._invalidate_count()
+        return result
 
 
 class ChromaMemory(AgentMemory):
     def __init__(self, path) -> None:
         self.chroma = chromadb.PersistentClient(path=path)
+        self.embedding_function = ChromaEmbeddingFunction()
+        self.collections = CollectionRegistry()
+        # chroma does not create collections safely from several threads at once,
+        # creating them is local and quick, so one lock serves every category
+        self.collection_lock = threading.Lock()
+        self.batches = threading.local()
+
+    @contextmanager
+    def batch(self):
+        """
+        Buffer the adds and upserts of this thread and send them as grouped upserts on exit.
+        Any other operation on a collection sends its buffered writes first, so they stay in order.
+        Chroma has no transactions: on error the buffered writes are dropped,
+        but deletes and updates that already ran are kept.
+        """
+        if getattr(self.batches, "pending", None) is not None:
+            # nested batches join the outer one
+            yield self
+            return
+
+        self.batches.pending = {}
+        try:
+            yield self
+        finally:
+            pending = self.batches.pending
+            self.batches.pending = None
+        for collection, calls in pending.items():
+            collection._write(calls)
 
     def get_or_create_collection(self, category, metadata=None) -> CollectionMemory:
-        memory = self.chroma.get_or_create_collection(category)
-        return ChromaCollectionMemory(memory, metadata)
+        def create():
+            with self.collection_lock:
+                memory = self.chroma.get_or_create_collection(
+                    category, embedding_function=self.embedding_function
+                )
+            return ChromaCollectionMemory(
+                memory, metadata, self.max_batch_size(), batches=self.batches
+            )
+
+        return self.collections.get_or_create(category, create)
 
     def get_collection(self, category) -> CollectionMemory:
-        memory = self.chroma.get_collection(category)
-        return ChromaCollectionMemory(memory)
+        def get():
+            # raises if the collection does not exist
+            with self.collection_lock:
+                memory = self.chroma.get_collection(
+                    category, embedding_function=self.embedding_function
+                )
+            return ChromaCollectionMemory(
+                memory, max_batch_size=self.max_batch_size(), batches=self.batches
+            )
+
+        return self.collections.get_or_create(category, get)
 
     def delete_collection(self, category):
+        # writes buffered for a deleted collection are dropped
+        pending = getattr(self.batches, "pending", None)
+        if pending:
+            pending.pop(self.collections.get(category), None)
+        self.collections.invalidate(category)
         self.chroma.delete_collection(category)
 
     def list_collections(self):
         return self.chroma.list_collections()
 
+    def create_embeddings(self, documents):
+        return self.embedding_function.embed(documents)
+
+    def max_batch_size(self):
+        # newer chroma versions expose the limit as a method
+        if hasattr(self.chroma, "get_max_batch_size"):
+            return self.chroma.get_max_batch_size()
+        return getattr(self.chroma, "max_batch_size", None)
+
 
 def create_client():
     STORAGE_PATH = os.environ.get("STORAGE_PATH", "./memory")
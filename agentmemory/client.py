@@ -1,5 +1,7 @@
 import os
+import threading
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 from dataclasses import dataclass
 from typing import List, Dict, Callable
 
@@ -50,10 +52,64 @@ def get_plugin_manager():
 
 
 class CollectionMemory(ABC):
+    # largest number of records a single add or upsert call should carry
+    max_batch_size = 1000
+    # whether query fails when asked for more results than the collection holds
+    query_needs_count = True
+
+    # cached number of records, None until the backend has been asked
+    _count = None
+    # bumped by every change, so a count read during a write is not cached
+    _count_generation = 0
+    # writes that have started but not adjusted the count yet
+    _pending_count_changes = 0
+    # shared by all collections, count adjustments are rare and short
+    _count_lock = threading.Lock()
+
     @abstractmethod
-    def count(self):
+    def count(self, where=None):
         raise NotImplementedError()
 
+    def _cached_count(self, load):
+        with self._count_lock:
+            if self._count is not None:
+                return self._count
+            generation = self._count_generation
+            pending = self._pending_count_changes
+
+        count = load()
+        with self._count_lock:
+            # a write in flight may or may not be in the loaded count
+            if pending == 0 and self._count_generation == generation:
+                self._count = count
+        return count
+
+    @contextmanager
+    def _count_change(self):
+        """
+        Wrap a write that adjusts the cached count once it is committed.
+        """
+        with self._count_lock:
+            self._pending_count_changes += 1
+            self._count_generation += 1
+        try:
+            yield
+        finally:
+            with self._count_lock:
+                self._pending_count_changes -= 1
+                self._count_generation += 1
+
+    def _adjust_count(self, delta):
+        with self._count_lock:
+            self._count_generation += 1
+            if self._count is not None:
+                self._count += delta
+
+    def _invalidate_count(self):
+        with self._count_lock:
+            self._count_generation += 1
+            self._count = None
+
     @abstractmethod
     def add(self, ids, documents=None, metadatas=None, embeddings=None):
         raise NotImplementedError()
@@ -67,9 +123,44 @@ class CollectionMemory(ABC):
         offset=None,
         where_document=None,
         include=["metadatas", "documents"],
+        order=None,
+        after=None,
     ):
+        """
+        order ("asc" or "desc") sorts the records by id before limit and offset
+        are applied. after only returns records whose id comes after it in that order.
+        """
         raise NotImplementedError()
 
+    def stream(
+        self,
+        where=None,
+        where_document=None,
+        include=["metadatas", "documents"],
+        order="asc",
+        page_size=100,
+    ):
+        """
+        Yield the matching records one page at a time, in get's format, using
+        the last id of each page as the cursor for the next one.
+        """
+        after = None
+        while True:
+            page = self.get(
+                where=where,
+                where_document=where_document,
+                limit=page_size,
+                include=include,
+                order=order,
+                after=after,
+            )
+            if len(page["ids"]) == 0:
+                return
+            yield page
+            if len(page["ids"]) < page_size:
+                return
+            after = page["ids"][-1]
+
     @abstractmethod
     def peek(self, limit=10):
         raise NotImplementedError()
@@ -103,6 +194,38 @@ class AgentCollection():
     name: str
 
 
+class CollectionRegistry:
+    """
+    Cache of collection handles by category, kept for the life of the client.
+    """
+
+    def __init__(self):
+        self.collections = {}
+        self.lock = threading.RLock()
+
+    def get(self, category):
+        return self.collections.get(category)
+
+    def get_or_create(self, category, factory: Callable[[], CollectionMemory]):
+        collection = self.collections.get(category)
+        if collection is not None:
+            return collection
+
+        # the handle is built outside the lock, building it may wait on the database and
+        # must not hold up threads asking for other categories. Building is idempotent,
+        # so when two threads race, the handle published first is kept.
+        collection = factory()
+        with self.lock:
+            return self.collections.setdefault(category, collection)
+
+    def invalidate(self, category=None):
+        with self.lock:
+            if category is None:
+                self.collections.clear()
+            else:
+                self.collections.pop(category, None)
+
+
 class AgentMemory(ABC):
     @abstractmethod
     def get_or_create_collection(self, category, metadata=None) -> CollectionMemory:
@@ -116,6 +239,28 @@ class AgentMemory(ABC):
     def list_collections(self) -> List[AgentCollection]:
         raise NotImplementedError()
 
+    def create_embeddings(self, documents):
+        """
+        Embed documents with the client's model. Clients that leave this
+        unimplemented are sent query texts instead of embeddings.
+        """
+        raise NotImplementedError()
+
+    @contextmanager
+    def batch(self):
+        """
+        Group operations into one unit of work. Clients that can't batch run them as they come.
+        """
+        yield self
+
+    def invalidate_collection(self, category=None):
+        """
+        Forget cached collection handles for a category, or for every category.
+        """
+        collections = getattr(self, "collections", None)
+        if isinstance(collections, CollectionRegistry):
+            collections.invalidate(category)
+
 
 DEFAULT_CLIENT_TYPE = "CHROMA"
 CLIENT_TYPE = os.environ.get("CLIENT_TYPE", DEFAULT_CLIENT_TYPE)
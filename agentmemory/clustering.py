@@ -1,22 +1,28 @@
-from agentmemory import search_memory, update_memory
+from agentmemory import iter_memories, search_memory_by_embedding, update_memories
+
+# labels are written in chunks of this many memories, so they never pile up for the whole category
+label_batch_size = 1000
+
 
 def cluster(epsilon, min_samples, category, filter_metadata=None, novel=False):
     """
     DBScan clustering. Updates memories directly with their cluster id.
     """
-    # Mark all memories as unvisited
-    memories = search_memory(category, "", n_results=float("inf"), filter_metadata=filter_metadata, novel=novel)
-    visited = {memory["id"]: False for memory in memories}
-    
+    # Stream the memories in the backend's own order instead of loading the whole category, only visited ids are kept
+    memories = iter_memories(category, page_size=1000, sort_order=None, filter_metadata=filter_metadata, novel=novel)
+    visited = set()
+
+    # labels are written in the order they are given, so the last label given to a memory wins
+    labels = {}
     cluster_id = 0
     for memory in memories:
         memory_id = memory["id"]
-        if visited[memory_id]:
+        if memory_id in visited:
             continue
-        visited[memory_id] = True
+        visited.add(memory_id)
 
-        # Finding neighboring memories based on the epsilon distance threshold
-        neighbors = search_memory(category, memory["document"], n_results=float("inf"), max_distance=epsilon, filter_metadata=filter_metadata, novel=novel)
+        # Finding neighboring memories based on the epsilon distance threshold, using the stored embedding
+        neighbors = search_memory_by_embedding(category, memory["embedding"], n_results=float("inf"), max_distance=epsilon, filter_metadata=filter_metadata, novel=novel)
 
         # get the current metadata
         metadata = memory.get("metadata", {})
@@ -24,17 +30,33 @@ def cluster(epsilon, min_samples, category, filter_metadata=None, novel=False):
         if len(neighbors) <= min_samples:
             # Update the metadata to indicate it's noise
             metadata["cluster"] = "noise"
-            # Update the memory's metadata directly to indicate it's noise
-            update_memory(category, memory_id, metadata=metadata)
+            _label(category, labels, memory_id, metadata)
         else:
             cluster_id += 1
             metadata["cluster"] = str(cluster_id)
             # Mark the current memory as part of the new cluster
-            update_memory(category, memory_id, metadata=metadata)
-            _expand_cluster(memory, neighbors, cluster_id, visited, epsilon, min_samples, category, filter_metadata, novel)
+            _label(category, labels, memory_id, metadata)
+            _expand_cluster(memory, neighbors, cluster_id, visited, epsilon, min_samples, category, filter_metadata, novel, labels)
+
+    _write_labels(category, labels)
+
+
+def _label(category, labels, memory_id, metadata):
+    """
+    Record the label of a memory, writing the recorded labels once a chunk is full.
+    """
+    labels[memory_id] = metadata
+    if len(labels) >= label_batch_size:
+        _write_labels(category, labels)
+
+
+def _write_labels(category, labels):
+    if labels:
+        update_memories(category, list(labels), metadatas=list(labels.values()))
+        labels.clear()
 
 
-def _expand_cluster(memory, neighbors, cluster_id, visited, epsilon, min_samples, category, filter_metadata, novel):
+def _expand_cluster(memory, neighbors, cluster_id, visited, epsilon, min_samples, category, filter_metadata, novel, labels):
     """
     Helper function to expand the clusters.
     """
@@ -43,9 +65,9 @@ def _expand_cluster(memory, neighbors, cluster_id, visited, epsilon, min_samples
         neighbor_memory = neighbors[idx]
         neighbor_id = neighbor_memory["id"]
 
-        if not visited[neighbor_id]:
-            visited[neighbor_id] = True
-            next_neighbors = search_memory(category, neighbor_memory["document"], n_results=float("inf"), max_distance=epsilon, filter_metadata=filter_metadata, novel=novel)
+        if neighbor_id not in visited:
+            visited.add(neighbor_id)
+            next_neighbors = search_memory_by_embedding(category, neighbor_memory["embedding"], n_results=float("inf"), max_distance=epsilon, filter_metadata=filter_metadata, novel=novel)
             if len(next_neighbors) >= min_samples:
                 neighbors += next_neighbors
 
@@ -54,6 +76,6 @@ def _expand_cluster(memory, neighbors, cluster_id, visited, epsilon, min_samples
         # Update the metadata to indicate it's part of the cluster
         metadata["cluster"] = str(cluster_id)
 
-        # Update the neighbor memory's metadata to indicate its cluster
-        update_memory(category, neighbor_id, metadata=metadata)
+        # Record the neighbor memory's cluster
+        _label(category, labels, neighbor_id, metadata)
         idx += 1
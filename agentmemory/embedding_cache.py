@@ -0,0 +1,356 @@
+import atexit
+import hashlib
+import json
+import os
+import threading
+import uuid
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+import numpy.typing as npt
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks, processes can't share a cache directory
+    fcntl = None
+
+default_cache_path = Path.home() / ".cache" / "agentmemory" / "embeddings"
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+KEY_SIZE = 16
+
+
+def text_key(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()[:KEY_SIZE]
+
+
+# caches flushed when the process exits, without keeping them alive until then
+open_caches = weakref.WeakSet()
+
+
+@atexit.register
+def flush_open_caches():
+    for cache in list(open_caches):
+        try:
+            cache.flush()
+        except OSError:
+            # the cache directory may have been removed
+            pass
+
+
+class EmbeddingCache:
+    """
+    On-disk cache of embeddings for one model, keyed by a hash of the text.
+
+    Vectors are stored in a memory-mapped float32 file with one slot per entry,
+    next to a file holding the key of each slot. An index file records which
+    slots are in use, least recently used first, and the oldest entries are
+    evicted once the vectors would take more than max_bytes.
+
+    The key stored with every slot is checked on each lookup, so an index that
+    was not flushed before the process stopped can only cause misses, never
+    wrong embeddings. Processes sharing the directory hold a lock file while
+    they read or write slots, and files are only ever replaced by renaming
+    new ones over them. Where fcntl is not available, only one process may use
+    a cache directory at a time.
+
+    Arguments:
+    path (str): Directory holding the cache files.
+    model_name (str): Name of the model the embeddings come from.
+    max_bytes (int): Maximum size of the vector file.
+    flush_every (int): Write the index after this many new entries.
+    """
+
+    def __init__(
+        self,
+        path=default_cache_path,
+        model_name="all-MiniLM-L6-v2",
+        max_bytes=DEFAULT_MAX_BYTES,
+        flush_every=1024,
+    ):
+        self.path = Path(path)
+        self.model_name = model_name
+        self.max_bytes = max_bytes
+        self.flush_every = flush_every
+        self.lock = threading.RLock()
+
+        self.dimensions = None
+        self.capacity = 0
+        self.vectors = None
+        self.keys = None
+        # key -> slot, least recently used first
+        self.entries = OrderedDict()
+        self.unflushed = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.lock_file = open(self._file("lock"), "a")
+        self.lock_depth = 0
+        self._load()
+        open_caches.add(self)
+
+    def _file(self, suffix):
+        return self.path / f"{self.model_name}.{suffix}"
+
+    @contextmanager
+    def _locked(self, exclusive=True):
+        """
+        Hold the thread lock and the lock file shared with other processes.
+        Nested calls keep the lock that is already held.
+        """
+        with self.lock:
+            if fcntl is None or self.lock_depth > 0:
+                self.lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self.lock_depth -= 1
+                return
+
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            self.lock_depth += 1
+            try:
+                yield
+            finally:
+                self.lock_depth -= 1
+                fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def _load(self):
+        with self._locked():
+            if not self._file("json").exists():
+                return
+
+            with open(self._file("json"), "r") as infile:
+                info = json.load(infile)
+            dimensions, capacity = info["dimensions"], info["capacity"]
+            # the files may have been replaced by a process with another budget since
+            if os.path.getsize(self._file("f32")) != capacity * dimensions * 4:
+                return
+            if os.path.getsize(self._file("keys")) != capacity * KEY_SIZE:
+                return
+            self._open(dimensions, capacity, mode="r+")
+
+            index_file = self._file("index.npy")
+            slots = np.load(index_file) if index_file.exists() else []
+            for slot in slots:
+                if slot < capacity:
+                    self.entries[self.keys[slot].tobytes()] = int(slot)
+
+            # the budget may have changed since the cache was written
+            if self._capacity_for(self.dimensions) != self.capacity:
+                self._resize()
+
+    def _capacity_for(self, dimensions):
+        return max(self.max_bytes // (dimensions * 4), 1)
+
+    def _open(self, dimensions, capacity, mode):
+        self.dimensions = dimensions
+        self.capacity = capacity
+        self.vectors = np.memmap(
+            self._file("f32"), dtype=np.float32, mode=mode, shape=(capacity, dimensions)
+        )
+        self.keys = np.memmap(
+            self._file("keys"), dtype=np.uint8, mode=mode, shape=(capacity, KEY_SIZE)
+        )
+
+    def _create(self, dimensions, capacity):
+        # new files are renamed over the old ones, so processes that still map
+        # the old files never see them truncated
+        for suffix, dtype, width in (("f32", np.float32, dimensions), ("keys", np.uint8, KEY_SIZE)):
+            temp_file = self._file(f"{suffix}.{uuid.uuid4().hex}.tmp")
+            np.memmap(temp_file, dtype=dtype, mode="w+", shape=(capacity, width)).flush()
+            os.replace(temp_file, self._file(suffix))
+        self._open(dimensions, capacity, mode="r+")
+        self.entries = OrderedDict()
+        self.flush(force=True)
+
+    def _resize(self):
+        # keep the most recently used entries that fit in the new budget
+        capacity = self._capacity_for(self.dimensions)
+        kept = list(self.entries.items())[-capacity:]
+        vectors = np.array([self.vectors[slot] for _, slot in kept], dtype=np.float32)
+
+        self.vectors = None
+        self.keys = None
+        self._create(self.dimensions, capacity)
+        for slot, (key, _) in enumerate(kept):
+            self.vectors[slot] = vectors[slot]
+            self.keys[slot] = np.frombuffer(key, dtype=np.uint8)
+            self.entries[key] = slot
+        self.flush(force=True)
+
+    def get_many(self, texts: List[str]) -> List[Optional[npt.NDArray]]:
+        """
+        Look up the embedding of each text. Texts that are not cached get None.
+        """
+        with self._locked(exclusive=False):
+            results = []
+            for text in texts:
+                key = text_key(text)
+                slot = self.entries.get(key)
+                if slot is None or self.keys[slot].tobytes() != key:
+                    self.misses += 1
+                    results.append(None)
+                    continue
+                self.entries.move_to_end(key)
+                self.hits += 1
+                results.append(np.array(self.vectors[slot]))
+            return results
+
+    def put_many(self, texts: List[str], embeddings: npt.NDArray) -> None:
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if len(texts) == 0:
+            return
+
+        with self._locked():
+            if self.vectors is None:
+                # another process may have created the files since this cache was opened
+                self._load()
+            if self.vectors is None:
+                dimensions = embeddings.shape[1]
+                self._create(dimensions, self._capacity_for(dimensions))
+
+            for text, embedding in zip(texts, embeddings):
+                key = text_key(text)
+                slot = self.entries.get(key)
+                if slot is not None:
+                    self.entries.move_to_end(key)
+                    continue
+
+                if len(self.entries) < self.capacity:
+                    slot = len(self.entries)
+                else:
+                    # evict the least recently used entry and reuse its slot
+                    _, slot = self.entries.popitem(last=False)
+
+                # the key is cleared while the vector changes and only written after it
+                self.keys[slot] = 0
+                self.vectors[slot] = embedding
+                self.keys[slot] = np.frombuffer(key, dtype=np.uint8)
+                self.entries[key] = slot
+                self.unflushed += 1
+
+            if self.unflushed >= self.flush_every:
+                self.flush()
+
+    def flush(self, force=False) -> None:
+        """
+        Write the vectors and the index to disk.
+        """
+        with self._locked():
+            if self.vectors is None or (self.unflushed == 0 and not force):
+                return
+
+            self.vectors.flush()
+            self.keys.flush()
+
+            # write to temporary files first so a crash never leaves a partial index
+            index_file = self._file("index.npy")
+            temp_index = self._file("index.tmp.npy")
+            np.save(temp_index, np.fromiter(self.entries.values(), dtype=np.int64))
+            os.replace(temp_index, index_file)
+
+            info_file = self._file("json")
+            temp_info = self._file("json.tmp")
+            with open(temp_info, "w") as outfile:
+                json.dump(
+                    {
+                        "model_name": self.model_name,
+                        "dimensions": self.dimensions,
+                        "capacity": self.capacity,
+                    },
+                    outfile,
+                )
+            os.replace(temp_info, info_file)
+
+            self.unflushed = 0
+
+    def clear(self) -> None:
+        with self._locked():
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.flush(force=True)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class QueryEmbeddingCache:
+    """
+    Bounded in-memory LRU of query embeddings, for search texts that agents
+    send over and over. The embeddings belong to one model at a time: they
+    are dropped when a lookup names another model.
+
+    Arguments:
+    max_size (int): Maximum number of embeddings kept.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.model = None
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, texts: List[str], embed, model=None) -> npt.NDArray:
+        """
+        Return the embedding of each text, calling embed once with every text
+        that is not cached. model is whatever the embeddings come from, such as
+        the client, and is compared by identity.
+        """
+        with self.lock:
+            if model is not self.model:
+                self.entries.clear()
+                self.model = model
+            results = []
+            for text in texts:
+                embedding = self.entries.get(text)
+                if embedding is None:
+                    self.misses += 1
+                else:
+                    self.entries.move_to_end(text)
+                    self.hits += 1
+                results.append(embedding)
+
+        missing = [index for index, embedding in enumerate(results) if embedding is None]
+        if len(missing) > 0:
+            # embed duplicated texts only once
+            missing_texts = list(dict.fromkeys(texts[index] for index in missing))
+            embeddings = np.asarray(embed(missing_texts), dtype=np.float32)
+            computed = dict(zip(missing_texts, embeddings))
+            with self.lock:
+                if model is not self.model:
+                    # the model changed while embedding, these belong to the old one
+                    missing_texts = []
+                for text in missing_texts:
+                    embedding = computed[text]
+                    self.entries[text] = embedding
+                    self.entries.move_to_end(text)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+            for index in missing:
+                results[index] = computed[texts[index]]
+
+        if len(results) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack(results)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.model = None
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
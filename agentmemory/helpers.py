@@ -62,54 +62,21 @@ def chroma_collection_to_list(collection):
     if isinstance(collection, list):
         return collection
 
-    # If there are no embeddings, zip metadatas, documents and ids together
-    if collection.get("embeddings", None) is None:
-        for metadata, document, id in zip(
-            collection["metadatas"], collection["documents"], collection["ids"]
-        ):
-            # append the zipped data as dictionary to the list
-            dict_list.append({"metadata": metadata, "document": document, "id": id})
-
-        return dict_list
-
-    # if distance is none, zip metadatas, documents, ids and embeddings together
-    if collection.get("distances", None) is None:
-        for metadata, document, id, embedding in zip(
-            collection["metadatas"],
-            collection["documents"],
-            collection["ids"],
-            collection["embeddings"],
-        ):
-            # append the zipped data as dictionary to the list
-            dict_list.append(
-                {
-                    "metadata": metadata,
-                    "document": document,
-                    "embedding": embedding,
-                    "id": id,
-                }
-            )
-
-        return dict_list
-
-    # if embeddings are present, zip all data including embeddings and distances
-    for metadata, document, id, embedding, distance in zip(
-        collection["metadatas"],
-        collection["documents"],
-        collection["ids"],
-        collection["embeddings"],
-        collection.get("distances"),
+    # embeddings and distances are only present if they were included
+    embeddings = collection.get("embeddings", None)
+    distances = collection.get("distances", None)
+
+    for index, (metadata, document, id) in enumerate(
+        zip(collection["metadatas"], collection["documents"], collection["ids"])
     ):
-        # append the zipped data as dictionary to the list
-        dict_list.append(
-            {
-                "metadata": metadata,
-                "document": document,
-                "embedding": embedding,
-                "distance": distance,
-                "id": id,
-            }
-        )
+        item = {"metadata": metadata, "document": document}
+        if embeddings is not None:
+            item["embedding"] = embeddings[index]
+        if distances is not None:
+            item["distance"] = distances[index]
+        item["id"] = id
+        dict_list.append(item)
+
     debug_log("Collection to list", {"collection": collection, "list": dict_list})
     return dict_list
 
@@ -192,6 +159,95 @@ def flatten_arrays(collection):
     return collection
 
 
+def split_query_results(collection):
+    """
+    Function to split a query response into one collection per query.
+
+    Arguments:
+    collection (dict): Query response with one nested list per query text.
+
+    Returns:
+    list: List of dictionaries, one for each query text.
+
+    Example:
+    >>> split_query_results({'ids': [['id1'], ['id2']], 'documents': [['document1'], ['document2']], 'metadatas': [[{}], [{}]]})
+    [{'ids': ['id1'], 'documents': ['document1'], 'metadatas': [{}]}, {'ids': ['id2'], 'documents': ['document2'], 'metadatas': [{}]}]
+    """
+
+    keys = ["ids", "documents", "metadatas", "embeddings", "distances"]
+
+    groups = []
+    for index in range(len(collection["ids"])):
+        group = {}
+        for key in keys:
+            if key not in collection:
+                continue
+            # keep missing values missing, so chroma_collection_to_list can check for them
+            values = collection[key]
+            group[key] = values[index] if values is not None else None
+        groups.append(group)
+
+    return groups
+
+
+def get_metadata_filter(filter_metadata=None, novel=False):
+    """
+    Function to build the where filter for a query or get.
+
+    Arguments:
+    filter_metadata (dict): Metadata to filter by. Values can be plain values or operator dicts.
+    novel (bool): Whether to only include memories that are marked as novel.
+
+    Returns:
+    dict: The where filter, or None if there is nothing to filter by.
+
+    Example:
+    >>> get_metadata_filter({"author": "Isaac Asimov"}, novel=True)
+    {'$and': [{'author': {'$eq': 'Isaac Asimov'}}, {'novel': {'$eq': 'True'}}]}
+    """
+
+    where = dict(filter_metadata) if filter_metadata is not None else None
+
+    if novel:
+        if where is None:
+            where = {}
+        where["novel"] = "True"
+
+    # multiple fields are combined with $and, each shaped like { "key": { "$eq": "value" } }
+    if where is not None and len(where.keys()) > 1:
+        where = {
+            "$and": [
+                {key: value}
+                if key.startswith("$") or isinstance(value, dict)
+                else {key: {"$eq": value}}
+                for key, value in where.items()
+            ]
+        }
+
+    return where
+
+
+def normalize_metadata(metadata):
+    """
+    Function to convert metadata values the backends can't store into strings.
+
+    Arguments:
+    metadata (dict): Metadata to normalize. Modified in place.
+
+    Returns:
+    dict: The normalized metadata.
+
+    Example:
+    >>> normalize_metadata({"novel": True})
+    {'novel': 'True'}
+    """
+    for key, value in metadata.items():
+        if isinstance(value, bool) or isinstance(value, dict) or isinstance(value, list):
+            debug_log(f"WARNING: Boolean metadata field {key} converted to string")
+            metadata[key] = str(value)
+    return metadata
+
+
 def get_include_types(include_embeddings, include_distances):
     """
     Function to get the types to include in results.
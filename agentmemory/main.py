@@ -1,17 +1,68 @@
 import datetime
 import os
 
+import numpy as np
+
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 from agentmemory.helpers import (
     chroma_collection_to_list,
     debug_log,
-    flatten_arrays,
     get_include_types,
+    get_metadata_filter,
+    normalize_metadata,
+    split_query_results,
 )
 
 
 from agentmemory.client import get_client
+from agentmemory.embedding_cache import QueryEmbeddingCache
+
+# embeddings of recent search texts, dropped whenever the client changes
+query_embedding_cache = QueryEmbeddingCache(
+    int(os.environ.get("QUERY_EMBEDDING_CACHE_SIZE", 1024))
+)
+
+
+def embed_search_texts(search_texts):
+    """
+    Embed search texts with the client's model, reusing the embeddings of recent searches.
+
+    Arguments:
+    search_texts (list): Texts to be searched.
+
+    Returns:
+    numpy.ndarray: One embedding per text, or None if the client embeds query texts itself.
+
+    Example:
+    >>> embed_search_texts(['current goal'])
+    """
+    client = get_client()
+    try:
+        return query_embedding_cache.get_many(
+            list(search_texts), client.create_embeddings, model=client
+        )
+    except NotImplementedError:
+        return None
+
+
+def transaction():
+    """
+    Group memory operations into one unit of work.
+
+    On Postgres every operation in the block runs in one transaction, committed when the block ends
+    and rolled back if it raises. On Chroma, memories created in the block are sent as grouped upserts.
+
+    Returns:
+    A context manager.
+
+    Example:
+    >>> with transaction():
+    ...     create_memory('events', 'first event')
+    ...     create_memory('events', 'second event')
+    """
+    return get_client().batch()
+
 
 def create_memory(category, text, metadata={}, embedding=None, id=None):
     """
@@ -37,12 +88,8 @@ def create_memory(category, text, metadata={}, embedding=None, id=None):
     metadata["created_at"] = datetime.datetime.now().timestamp()
     metadata["updated_at"] = datetime.datetime.now().timestamp()
 
-    # for each field in metadata...
-    # if the field is a boolean, convert it to a string
-    for key, value in metadata.items():
-        if isinstance(value, bool) or isinstance(value, dict) or isinstance(value, list):
-            debug_log(f"WARNING: Boolean metadata field {key} converted to string")
-            metadata[key] = str(value)
+    # convert booleans, dicts and lists to strings
+    normalize_metadata(metadata)
 
     # insert the document into the collection
     memories.upsert(
@@ -56,6 +103,74 @@ def create_memory(category, text, metadata={}, embedding=None, id=None):
     return id
 
 
+def create_memories(
+    category, texts, metadatas=None, ids=None, embeddings=None, batch_size=None
+):
+    """
+    Create many memories in a collection at once.
+
+    Arguments:
+    category (str): Category of the collection.
+    texts (list): Document texts.
+    metadatas (list, optional): One metadata dict per text.
+    ids (list, optional): One unique id per text. Generated incrementally unless set.
+    embeddings (list, optional): One embedding per text. Use if you already have embeddings.
+    batch_size (int, optional): Number of memories sent to the backend per upsert.
+        Defaults to the largest batch the backend accepts.
+
+    Returns:
+    list: The id of each memory, in the order of texts, including the generated ones.
+
+    Example:
+    >>> create_memories('sample_category', ['text 1', 'text 2'], metadatas=[{'key': 'a'}, {'key': 'b'}])
+    """
+
+    texts = list(texts)
+    if len(texts) == 0:
+        return []
+
+    if metadatas is None:
+        metadatas = [{} for _ in texts]
+    if ids is None:
+        ids = [None] * len(texts)
+    if embeddings is not None and hasattr(embeddings, "tolist"):
+        embeddings = embeddings.tolist()
+
+    for name, values in (("metadatas", metadatas), ("ids", ids), ("embeddings", embeddings)):
+        if values is not None and len(values) != len(texts):
+            raise ValueError(f"Expected {len(texts)} {name}, got {len(values)}")
+
+    # get or create the collection
+    memories = get_client().get_or_create_collection(category)
+
+    # every memory in the batch gets the same timestamps
+    timestamp = datetime.datetime.now().timestamp()
+    normalized_metadatas = []
+    for metadata in metadatas:
+        metadata = dict(metadata)
+        metadata["created_at"] = timestamp
+        metadata["updated_at"] = timestamp
+        normalized_metadatas.append(normalize_metadata(metadata))
+
+    # send the memories to the backend in chunks it can accept
+    batch_size = batch_size or memories.max_batch_size
+    created_ids = []
+    for start in range(0, len(texts), batch_size):
+        end = start + batch_size
+        # the backend returns the ids it assigned
+        created_ids.extend(
+            memories.upsert(
+                ids=ids[start:end],
+                documents=texts[start:end],
+                metadatas=normalized_metadatas[start:end],
+                embeddings=embeddings[start:end] if embeddings is not None else None,
+            )
+        )
+
+    debug_log(f"Created {len(texts)} memories in category {category}")
+    return created_ids
+
+
 def create_unique_memory(category, content, metadata={}, similarity=0.95):
     """
     Creates a new memory if there aren't any that are very similar to it
@@ -130,6 +245,210 @@ def search_memory(
     [{'metadata': '...', 'document': '...', 'id': '...'}, {'metadata': '...', 'document': '...', 'id': '...'}]
     """
 
+    return search_memories(
+        category,
+        [search_text],
+        n_results=n_results,
+        filter_metadata=filter_metadata,
+        contains_text=contains_text,
+        include_embeddings=include_embeddings,
+        include_distances=include_distances,
+        max_distance=max_distance,
+        min_distance=min_distance,
+        novel=novel,
+    )[0]
+
+
+def search_memories(
+    category,
+    search_texts,
+    n_results=5,
+    filter_metadata=None,
+    contains_text=None,
+    include_embeddings=True,
+    include_distances=True,
+    max_distance=None,  # 0.0 - 1.0
+    min_distance=None,  # 0.0 - 1.0
+    novel=False,
+):
+    """
+    Search a collection with several query texts in a single backend query.
+
+    Arguments:
+    category (str): Category of the collection.
+    search_texts (list): Texts to be searched.
+    n_results (int): Number of results to be returned for each text.
+    filter_metadata (dict): Metadata for filtering the results.
+    contains_text (str): Text that must be contained in the documents.
+    include_embeddings (bool): Whether to include embeddings in the results.
+    include_distances (bool): Whether to include distances in the results.
+    max_distance (float): Only include memories with this distance threshold maximum.
+    min_distance (float): Only include memories that are at least this distance
+    novel (bool): Only include memories that are marked as novel
+
+    Returns:
+    list: One list of search results for each search text, in the same order.
+
+    Example:
+    >>> search_memories('sample_category', ['first query', 'second query'], n_results=2)
+    [[{'metadata': '...', 'document': '...', 'id': '...'}], [{'metadata': '...', 'document': '...', 'id': '...'}]]
+    """
+
+    search_texts = list(search_texts)
+    if len(search_texts) == 0:
+        return []
+
+    # embed the texts once, reusing recent search embeddings
+    query_embeddings = embed_search_texts(search_texts)
+
+    results = _search(
+        category,
+        query_embeddings=query_embeddings,
+        query_texts=search_texts if query_embeddings is None else None,
+        n_results=n_results,
+        filter_metadata=filter_metadata,
+        contains_text=contains_text,
+        include_embeddings=include_embeddings,
+        include_distances=include_distances,
+        max_distance=max_distance,
+        min_distance=min_distance,
+        novel=novel,
+    )
+
+    debug_log(f"Searched memory: {search_texts}", results)
+
+    return results
+
+
+def search_memory_by_embedding(
+    category,
+    embedding,
+    n_results=5,
+    filter_metadata=None,
+    contains_text=None,
+    include_embeddings=True,
+    include_distances=True,
+    max_distance=None,  # 0.0 - 1.0
+    min_distance=None,  # 0.0 - 1.0
+    novel=False,
+):
+    """
+    Search a collection with an embedding instead of a text, without running the model.
+
+    Arguments:
+    category (str): Category of the collection.
+    embedding (list): Embedding to be searched.
+    n_results (int): Number of results to be returned.
+    filter_metadata (dict): Metadata for filtering the results.
+    contains_text (str): Text that must be contained in the documents.
+    include_embeddings (bool): Whether to include embeddings in the results.
+    include_distances (bool): Whether to include distances in the results.
+    max_distance (float): Only include memories with this distance threshold maximum.
+    min_distance (float): Only include memories that are at least this distance
+    novel (bool): Only include memories that are marked as novel
+
+    Returns:
+    list: List of search results.
+
+    Example:
+    >>> search_memory_by_embedding('sample_category', memory['embedding'], n_results=2)
+    [{'metadata': '...', 'document': '...', 'id': '...'}, {'metadata': '...', 'document': '...', 'id': '...'}]
+    """
+
+    results = _search(
+        category,
+        query_embeddings=[embedding],
+        n_results=n_results,
+        filter_metadata=filter_metadata,
+        contains_text=contains_text,
+        include_embeddings=include_embeddings,
+        include_distances=include_distances,
+        max_distance=max_distance,
+        min_distance=min_distance,
+        novel=novel,
+    )[0]
+
+    debug_log(f"Searched memory by embedding in category {category}", results)
+
+    return results
+
+
+def search_similar_to(
+    category,
+    id,
+    n_results=5,
+    filter_metadata=None,
+    contains_text=None,
+    include_embeddings=True,
+    include_distances=True,
+    max_distance=None,  # 0.0 - 1.0
+    min_distance=None,  # 0.0 - 1.0
+    novel=False,
+):
+    """
+    Find the memories most similar to an existing memory, using its stored embedding.
+    The memory itself is left out of the results.
+
+    Arguments:
+    category (str): Category of the collection.
+    id (str/int): ID of the memory to compare against.
+    n_results (int): Number of results to be returned.
+    filter_metadata (dict): Metadata for filtering the results.
+    contains_text (str): Text that must be contained in the documents.
+    include_embeddings (bool): Whether to include embeddings in the results.
+    include_distances (bool): Whether to include distances in the results.
+    max_distance (float): Only include memories with this distance threshold maximum.
+    min_distance (float): Only include memories that are at least this distance
+    novel (bool): Only include memories that are marked as novel
+
+    Returns:
+    list: List of search results, or an empty list if the memory does not exist.
+
+    Example:
+    >>> search_similar_to('sample_category', '1', n_results=2)
+    [{'metadata': '...', 'document': '...', 'id': '...'}, {'metadata': '...', 'document': '...', 'id': '...'}]
+    """
+
+    memory = get_memory(category, id, include_embeddings=True)
+    if memory is None:
+        return []
+
+    # ask for one extra result, since the memory matches itself
+    results = search_memory_by_embedding(
+        category,
+        memory["embedding"],
+        n_results=n_results + 1,
+        filter_metadata=filter_metadata,
+        contains_text=contains_text,
+        include_embeddings=include_embeddings,
+        include_distances=include_distances,
+        max_distance=max_distance,
+        min_distance=min_distance,
+        novel=novel,
+    )
+
+    return [result for result in results if str(result["id"]) != str(id)][:n_results]
+
+
+def _search(
+    category,
+    query_embeddings=None,
+    query_texts=None,
+    n_results=5,
+    filter_metadata=None,
+    contains_text=None,
+    include_embeddings=True,
+    include_distances=True,
+    max_distance=None,
+    min_distance=None,
+    novel=False,
+):
+    """
+    Query a collection with embeddings or texts and return one list of results per query.
+    """
+
+    queries = query_embeddings if query_embeddings is not None else query_texts
+
     # check if contains_text is provided and format it for the query
     if contains_text is not None:
         contains_text = {"$contains": contains_text}
@@ -137,53 +456,48 @@ def search_memory(
     # get or create the collection
     memories = get_client().get_or_create_collection(category)
 
-    if (memories.count()) == 0:
-        return []
+    if memories.query_needs_count:
+        count = memories.count()
+        if count == 0:
+            return [[] for _ in queries]
 
-    # min n_results to prevent searching for more elements than are available
-    n_results = min(n_results, memories.count())
+        # min n_results to prevent searching for more elements than are available
+        n_results = min(n_results, count)
+    elif n_results == float("inf"):
+        # no limit, the backend returns every match
+        n_results = None
 
     # get the types to include
     include_types = get_include_types(include_embeddings, include_distances)
 
-    # filter_metadata is a dictionary of metadata to filter by
-    if filter_metadata is not None and len(filter_metadata.keys()) > 1:
-        # map each key:value in filter_metadata to an object shaped like { "key": { "$eq": "value" } }
-        filter_metadata = [
-            {key: {"$eq": value}} for key, value in filter_metadata.items()
-        ]
-
-        filter_metadata = {"$and": filter_metadata}
+    if query_embeddings is not None:
+        # stored embeddings may come back as numpy arrays
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32).tolist()
 
-    if novel:
-        if filter_metadata is None:
-            filter_metadata = {}
-        filter_metadata["novel"] = "True"
-
-    # perform the query and get the response
+    # perform the query and get the response, with one group of results per query
     query = memories.query(
-        query_texts=[search_text],
-        where=filter_metadata,
+        query_embeddings=query_embeddings,
+        query_texts=query_texts,
+        where=get_metadata_filter(filter_metadata, novel),
         where_document=contains_text,
         n_results=n_results,
         include=include_types,
     )
 
-    # if isinstance(query, list):
-    query = flatten_arrays(query)
-
-    # convert the query response to list and return
-    result_list = chroma_collection_to_list(query)
+    results = []
+    for group in split_query_results(query):
+        # convert the query response to list
+        result_list = chroma_collection_to_list(group)
 
-    if min_distance is not None and min_distance > 0:
-        result_list = [res for res in result_list if res["distance"] >= min_distance]
+        if min_distance is not None and min_distance > 0:
+            result_list = [res for res in result_list if res["distance"] >= min_distance]
 
-    if max_distance is not None and max_distance < 1.0:
-        result_list = [res for res in result_list if res["distance"] <= max_distance]
+        if max_distance is not None and max_distance < 1.0:
+            result_list = [res for res in result_list if res["distance"] <= max_distance]
 
-    debug_log(f"Searched memory: {search_text}", result_list)
+        results.append(result_list)
 
-    return result_list
+    return results
 
 
 def get_memory(category, id, include_embeddings=True):
@@ -255,9 +569,6 @@ def get_memories(
     # Get or create the collection for the given category
     memories = get_client().get_or_create_collection(category)
 
-    # min n_results to prevent searching for more elements than are available
-    n_results = min(n_results, memories.count())
-
     # Get the types to include based on the function parameters
     include_types = get_include_types(include_embeddings, False)
 
@@ -266,40 +577,77 @@ def get_memories(
     if contains_text is not None:
         where_document = {"$contains": contains_text}
 
-    # filter_metadata is a dictionary of metadata to filter by
-    if filter_metadata is not None and len(filter_metadata.keys()) > 1:
-        # map each key:value in filter_metadata to an object shaped like { "key": { "$eq": "value" } }
-        filter_metadata = [
-            {key: {"$eq": value}} for key, value in filter_metadata.items()
-        ]
-
-        filter_metadata = {"$and": filter_metadata}
-
-    if novel:
-        if filter_metadata is None:
-            filter_metadata = {}
-        filter_metadata["novel"] = "True"
-
-    # Retrieve all memories that meet the given metadata filter
+    # Let the backend sort the memories by ID and only return the top n_results
     memories = memories.get(
-        where=filter_metadata, where_document=where_document, include=include_types
+        where=get_metadata_filter(filter_metadata, novel),
+        where_document=where_document,
+        limit=n_results,
+        include=include_types,
+        order=sort_order,
     )
 
     if not isinstance(memories, list):
         # Convert the collection to list format
         memories = chroma_collection_to_list(memories)
 
-    # Sort memories by ID. If sort_order is 'desc', then the reverse parameter will be True, and memories will be sorted in descending order.
-    memories.sort(key=lambda x: x["id"], reverse=sort_order == "desc")
-
-    # Only keep the top n_results memories
-    memories = memories[:n_results]
-
     debug_log(f"Got memories from category {category}", memories)
 
     return memories
 
 
+def iter_memories(
+    category,
+    page_size=100,
+    sort_order="asc",
+    contains_text=None,
+    filter_metadata=None,
+    include_embeddings=True,
+    novel=False,
+):
+    """
+    Iterate over every memory in a category, sorted by ID, fetching one page at a time.
+    No database connection is held between pages, so the loop can make other memory calls.
+
+    Arguments:
+        category (str): The category of the memories.
+        page_size (int, optional): The number of memories fetched per page. Defaults to 100.
+        sort_order (str, optional): The sorting order of the memories. Can be 'asc' or 'desc'. Defaults to 'asc'.
+            None keeps the backend's own order, which on Chroma avoids listing and sorting every id first.
+        contains_text (str, optional): Text that must be contained in the documents. Defaults to None.
+        filter_metadata (dict, optional): Filter to apply on metadata. Defaults to None.
+        include_embeddings (bool, optional): Whether to include the embeddings. Defaults to True.
+        novel (bool, optional): Whether to only include memories that are marked as novel. Defaults to False.
+
+    Yields:
+        dict: The next memory.
+
+    Example:
+        >>> for memory in iter_memories("books", page_size=500):
+        ...     print(memory["document"])
+    """
+
+    # Get or create the collection for the given category
+    memories = get_client().get_or_create_collection(category)
+
+    # Get the types to include based on the function parameters
+    include_types = get_include_types(include_embeddings, False)
+
+    where_document = None
+
+    if contains_text is not None:
+        where_document = {"$contains": contains_text}
+
+    pages = memories.stream(
+        where=get_metadata_filter(filter_metadata, novel),
+        where_document=where_document,
+        include=include_types,
+        order=sort_order,
+        page_size=page_size,
+    )
+    for page in pages:
+        yield from chroma_collection_to_list(page)
+
+
 def update_memory(category, id, text=None, metadata=None, embedding=None):
     """
     Update a memory with new text and/or metadata.
@@ -327,11 +675,8 @@ def update_memory(category, id, text=None, metadata=None, embedding=None):
     if metadata is None and text is None:
         raise Exception("No text or metadata provided")
     if metadata is not None:
-        # for each key value in metadata -- if the type is boolean, convert it to string
-        for key, value in metadata.items():
-            if isinstance(value, bool) or isinstance(value, dict) or isinstance(value, list):
-                debug_log(f"WARNING: Boolean metadata field {key} converted to string")
-                metadata[key] = str(value)
+        # convert booleans, dicts and lists to strings
+        normalize_metadata(metadata)
     else:
         metadata = {}
 
@@ -351,6 +696,62 @@ def update_memory(category, id, text=None, metadata=None, embedding=None):
     )
 
 
+def update_memories(category, ids, texts=None, metadatas=None, embeddings=None):
+    """
+    Update many memories at once.
+
+    Arguments:
+    category (str): Category of the collection.
+    ids (list): Ids of the memories to update.
+    texts (list, optional): One new text per id. None keeps the current text.
+    metadatas (list, optional): One metadata dict per id. Only the given keys are changed.
+    embeddings (list, optional): One embedding per id. Texts without one are embedded again.
+
+    Returns:
+    None
+
+    Raises:
+    Exception: If neither texts, metadatas nor embeddings are provided.
+
+    Example:
+    >>> update_memories("books", ["1", "2"], metadatas=[{"shelf": "a"}, {"shelf": "b"}])
+    """
+
+    ids = [str(id) for id in ids]
+    if texts is None and metadatas is None and embeddings is None:
+        raise Exception("No texts, metadatas or embeddings provided")
+    if len(ids) == 0:
+        return
+
+    if metadatas is None:
+        metadatas = [{} for _ in ids]
+    if embeddings is not None and hasattr(embeddings, "tolist"):
+        embeddings = embeddings.tolist()
+
+    for name, values in (("texts", texts), ("metadatas", metadatas), ("embeddings", embeddings)):
+        if values is not None and len(values) != len(ids):
+            raise ValueError(f"Expected {len(ids)} {name}, got {len(values)}")
+
+    memories = get_client().get_or_create_collection(category)
+
+    # every memory in the batch gets the same timestamp
+    timestamp = datetime.datetime.now().timestamp()
+    normalized_metadatas = []
+    for metadata in metadatas:
+        metadata = dict(metadata)
+        metadata["updated_at"] = timestamp
+        normalized_metadatas.append(normalize_metadata(metadata))
+
+    memories.update(
+        ids=ids,
+        documents=list(texts) if texts is not None else None,
+        metadatas=normalized_metadatas,
+        embeddings=embeddings,
+    )
+
+    debug_log(f"Updated {len(ids)} memories in category {category}")
+
+
 def delete_memory(category, id):
     """
     Delete a memory by ID.
@@ -487,6 +888,7 @@ def count_memories(category, novel=False):
 
     Arguments:
         category (str): The category of the memories.
+        novel (bool, optional): Whether to only count memories that are marked as novel. Defaults to False.
 
     Returns:
         int: The number of memories.
@@ -498,13 +900,13 @@ def count_memories(category, novel=False):
     # Get or create the collection for the given category
     memories = get_client().get_or_create_collection(category)
 
-    if novel:
-        memories = memories.get(where={"novel": "True"})
+    # novel memories are counted by the backend, without fetching them
+    count = memories.count(where=get_metadata_filter(novel=True) if novel else None)
 
-    debug_log(f"Counted memories in {category}: {memories.count()}")
+    debug_log(f"Counted memories in {category}: {count}")
 
     # Return the count of memories
-    return memories.count()
+    return count
 
 
 def wipe_category(category):
@@ -520,6 +922,9 @@ def wipe_category(category):
 
     collection = None
 
+    # forget the cached handle so the existence check below hits the backend
+    get_client().invalidate_collection(category)
+
     try:
         collection = get_client().get_collection(
             category
@@ -549,4 +954,7 @@ def wipe_all_memories():
     for collection in collections:
         client.delete_collection(collection.name)
 
+    # drop any handles to collections that were not listed
+    client.invalidate_collection()
+
     debug_log("Wiped all memories", type="system")
@@ -1,7 +1,7 @@
 import json
 from agentmemory import (
     create_memory,
-    get_memories,
+    iter_memories,
     wipe_all_memories,
 )
 from agentmemory.client import get_client
@@ -31,8 +31,10 @@ def export_memory_to_json(include_embeddings=True):
         collection_name = collection.name
         collections_dict[collection_name] = []
 
-        # Get all memories from the current collection
-        memories = get_memories(collection_name, include_embeddings=include_embeddings)
+        # Stream every memory of the current collection, a page at a time
+        memories = iter_memories(
+            collection_name, page_size=1000, include_embeddings=include_embeddings
+        )
         for memory in memories:
             # Append each memory to its corresponding collection list
             collections_dict[collection_name].append(memory)
@@ -59,9 +61,9 @@ def export_memory_to_file(path="./memory.json", include_embeddings=True):
     print('collections_dict')
     print(collections_dict)
 
-    # Write the dictionary to a JSON file
+    # Write the dictionary to a JSON file, timestamp metadata is written as text
     with open(path, "w") as outfile:
-        json.dump(collections_dict, outfile)
+        json.dump(collections_dict, outfile, default=str)
 
 
 def import_json_to_memory(data, replace=True):
@@ -1,15 +1,28 @@
 from __future__ import annotations
 from pathlib import Path
+import datetime
 import os
-from functools import reduce
-from itertools import repeat
+import threading
+import uuid
+from contextlib import contextmanager
 
-import psycopg2
+import numpy as np
+from psycopg2.extensions import connection as Connection
+from psycopg2.extras import Json, execute_values
+from psycopg2.pool import ThreadedConnectionPool
 
-from .client import AgentMemory, CollectionMemory, AgentCollection
-from .check_model import check_model, infer_embeddings
+from .client import AgentMemory, CollectionMemory, AgentCollection, CollectionRegistry
+from .check_model import check_model, embed_documents
 import agentlogger
 
+class VectorConnection(Connection):
+    """
+    Pooled connection that remembers whether the vector type was registered on it.
+    """
+
+    vector_registered = False
+
+
 def parse_metadata(where):
     where = where or {}
     metadata = {}
@@ -25,28 +38,180 @@ def parse_metadata(where):
     return metadata
 
 
-def handle_and_condition(and_conditions):
+# columns every category table has, the rest hold metadata
+reserved_columns = ("id", "document", "embedding", "document_tsv", "embedding_bits")
+
+# tables estimated to hold fewer rows than this are counted exactly
+exact_count_threshold = 10000
+
+# text search configuration of the document_tsv column, no stemming or stop words
+text_search_config = "simple"
+
+
+def handle_and_condition(and_conditions, jsonb=False, tokens=False, types=None):
     conditions = []
     params = []
     for condition in and_conditions:
         for key, value in condition.items():
-            for operator, operand in value.items():
-                sql_operator = get_sql_operator(operator)
-                conditions.append(f"{key} {sql_operator} %s")
-                params.append(operand)
+            new_conditions, new_params = handle_condition(key, value, jsonb, tokens, types)
+            conditions.extend(new_conditions)
+            params.extend(new_params)
     return conditions, params
 
 
-def handle_or_condition(or_conditions):
+def handle_or_condition(or_conditions, jsonb=False, tokens=False, types=None):
     or_groups = []
     params = []
     for condition in or_conditions:
-        conditions, new_params = handle_and_condition([condition])
+        conditions, new_params = handle_and_condition([condition], jsonb, tokens, types)
         or_groups.append(" AND ".join(conditions))
         params.extend(new_params)
     return f"({') OR ('.join(or_groups)})", params
 
 
+def handle_condition(key, value, jsonb=False, tokens=False, types=None):
+    """
+    Translate one key of a where filter into SQL conditions and their parameters.
+    types maps metadata columns to their SQL type, when it is known.
+    """
+    if key == "$and":
+        return handle_and_condition(value, jsonb, tokens, types)
+    if key == "$or":
+        or_condition, params = handle_or_condition(value, jsonb, tokens, types)
+        return [or_condition], params
+    if key == "$contains":
+        return document_condition(value, tokens)
+    if not isinstance(value, dict):
+        value = {"$eq": value}
+
+    conditions = []
+    params = []
+    for operator, operand in value.items():
+        condition, new_params = metadata_condition(key, operator, operand, jsonb, types)
+        conditions.append(condition)
+        params.extend(new_params)
+    return conditions, params
+
+
+def metadata_condition(key, operator, operand, jsonb=False, types=None):
+    sql_operator = get_sql_operator(operator)
+    operands = list(operand) if operator in ("$in", "$nin") else [operand]
+    if len(operands) == 0:
+        # nothing is in an empty list
+        return ("FALSE" if operator == "$in" else "TRUE"), []
+
+    # operands are sent as untyped literals, which postgres converts to the column type
+    literals = [None if value is None else str(value) for value in operands]
+    param = tuple(literals) if operator in ("$in", "$nin") else literals[0]
+
+    if not jsonb:
+        if (types or {}).get(key) in ("BIGINT", "DOUBLE PRECISION") and all(is_number(value) for value in operands):
+            # numbers are sent as numbers, so a float compares exactly with an integer column
+            numbers = tuple(operands) if operator in ("$in", "$nin") else operand
+            return f"{key} {sql_operator} %s", [numbers]
+        return f"{key} {sql_operator} %s", [param]
+    if operator == "$eq":
+        # containment is answered by the GIN index
+        return "metadata @> %s", [jsonb_metadata({key: operand})]
+    if all(is_number(value) for value in operands):
+        # values are stored as text, cast them back to compare numbers numerically
+        numbers = tuple(operands) if operator in ("$in", "$nin") else operand
+        return f"{numeric_metadata('(metadata->>%s)')} {sql_operator} %s", [key, key, numbers]
+    # values are compared as text, like text metadata columns
+    return f"metadata->>%s {sql_operator} %s", [key, param]
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+# text written by str() for an int or a float, which double precision can parse
+numeric_pattern = r"^-?[0-9]+(\.[0-9]+)?(e[-+]?[0-9]+)?$"
+
+
+def numeric_metadata(field):
+    """
+    Expression reading a JSONB metadata value as a number.
+    Values are stored as text, so jsonb_typeof cannot tell numbers apart; values that do
+    not look like a number read as null instead of failing the cast for the whole query.
+    """
+    return f"(CASE WHEN {field} ~ '{numeric_pattern}' THEN {field}::double precision END)"
+
+
+def column_type(value):
+    """
+    Postgres type of a metadata column that can hold the given value.
+    """
+    if isinstance(value, dict):
+        # a filter such as {"$gt": 3}
+        return column_type(next(iter(value.values()), None))
+    if isinstance(value, (list, tuple)):
+        return column_type(value[0] if len(value) > 0 else None)
+    if isinstance(value, bool):
+        return "BOOLEAN"
+    if isinstance(value, int):
+        return "BIGINT"
+    if isinstance(value, float):
+        return "DOUBLE PRECISION"
+    if isinstance(value, datetime.datetime):
+        return "TIMESTAMPTZ"
+    return "TEXT"
+
+
+# column types as the catalog names them
+catalog_types = {
+    "boolean": "BOOLEAN",
+    "bigint": "BIGINT",
+    "double precision": "DOUBLE PRECISION",
+    "timestamp with time zone": "TIMESTAMPTZ",
+    "text": "TEXT",
+}
+
+
+def widened_type(current, wanted):
+    """
+    Narrowest column type that holds values of both types: integers widen to
+    double precision, any other mix widens to text.
+    """
+    if current == wanted:
+        return current
+    if {current, wanted} == {"BIGINT", "DOUBLE PRECISION"}:
+        return "DOUBLE PRECISION"
+    return "TEXT"
+
+
+def metadata_column_types(metadatas):
+    """
+    Column type of each metadata key that holds every value written under it.
+    Keys that are only given None map to None, they fit any column.
+    """
+    types = {}
+    for metadata in metadatas:
+        for key, value in metadata.items():
+            if value is None:
+                types.setdefault(key, None)
+            elif types.get(key) is None:
+                types[key] = column_type(value)
+            else:
+                types[key] = widened_type(types[key], column_type(value))
+    return types
+
+
+def document_condition(text, tokens=False):
+    if tokens:
+        # every word of the text must appear in the document, answered by the tsvector index
+        return [
+            f"document_tsv @@ plainto_tsquery('{text_search_config}', %s)"
+        ], [text]
+    # substring match, answered by a trigram index if there is one
+    return ["document LIKE %s"], [f"%{text}%"]
+
+
+def jsonb_metadata(metadata):
+    # values are stored as text, so JSONB metadata reads and compares like metadata columns
+    return Json({key: None if value is None else str(value) for key, value in metadata.items()})
+
+
 def get_sql_operator(operator):
     if operator == "$eq":
         return "="
@@ -56,34 +221,32 @@ def get_sql_operator(operator):
         return ">"
     elif operator == "$lt":
         return "<"
+    elif operator == "$gte":
+        return ">="
+    elif operator == "$lte":
+        return "<="
+    elif operator == "$in":
+        return "IN"
+    elif operator == "$nin":
+        return "NOT IN"
     else:
         raise ValueError(f"Operator {operator} not supported")
 
-def parse_conditions(where=None, where_document=None, ids=None):
+def parse_conditions(where=None, where_document=None, ids=None, jsonb=False, tokens=False, types=None):
     conditions = []
     params = []
     if where_document is not None:
         if where_document.get("$contains", None) is not None:
             where_document = where_document["$contains"]
-        conditions.append("document LIKE %s")
-        params.append(f"%{where_document}%")
+        new_conditions, new_params = document_condition(where_document, tokens)
+        conditions.extend(new_conditions)
+        params.extend(new_params)
 
     if where:
         for key, value in where.items():
-            if key == "$and":
-                new_conditions, new_params = handle_and_condition(value)
-                conditions.extend(new_conditions)
-                params.extend(new_params)
-            elif key == "$or":
-                or_condition, new_params = handle_or_condition(value)
-                conditions.append(or_condition)
-                params.extend(new_params)
-            elif key == "$contains":
-                conditions.append(f"document LIKE %s")
-                params.append(f"%{value}%")
-            else:
-                conditions.append(f"{key}=%s")
-                params.append(str(value))
+            new_conditions, new_params = handle_condition(key, value, jsonb, tokens, types)
+            conditions.extend(new_conditions)
+            params.extend(new_params)
 
     if ids:
         if not all(isinstance(i, str) or isinstance(i, int) for i in ids):
@@ -96,37 +259,213 @@ def parse_conditions(where=None, where_document=None, ids=None):
 
     return conditions, params
 
+
+def rows_to_collection(rows, columns, include, distances=None, jsonb=False):
+    """
+    Convert rows fetched with the given columns into a chroma-style collection.
+    Keys that were not included are None.
+    """
+    index = {col: i for i, col in enumerate(columns)}
+    metadata_columns = [
+        col for col in columns if col not in reserved_columns
+    ]
+
+    output = {
+        "ids": [row[0] for row in rows],
+        "documents": None,
+        "metadatas": None,
+        "embeddings": None,
+        "distances": None,
+    }
+    if "documents" in include:
+        output["documents"] = [row[index["document"]] for row in rows]
+    if "metadatas" in include and jsonb:
+        output["metadatas"] = [row[index["metadata"]] for row in rows]
+    elif "metadatas" in include:
+        output["metadatas"] = [
+            {col: row[index[col]] for col in metadata_columns} for row in rows
+        ]
+    if "embeddings" in include:
+        # transform from ndarray to list
+        output["embeddings"] = [row[index["embedding"]].tolist() for row in rows]
+    if "distances" in include and distances is not None:
+        output["distances"] = distances
+    return output
+
+
 class PostgresCollection(CollectionMemory):
+    # LIMIT already stops at the last row, and counts may be estimates
+    query_needs_count = False
+
     def __init__(self, category, client: PostgresClient, metadata=None):
         self.category = category
         self.client = client
         self.metadata = metadata or {}
         client.ensure_table_exists(category)
+        # columns are loaded from the catalog once, then kept up to date as they are added or widened
+        self._load_columns()
         if metadata:
-            client._ensure_metadata_columns_exist(category, metadata)
+            self._validate_metadata(metadata)
+
+    def _load_columns(self):
+        types = self.client.column_types(self.category)
+        self.columns = list(types)
+        self.types = {column: catalog_types.get(type, type) for column, type in types.items()}
 
     def _validate_metadata(self, metadata):
-        if new_columns := set(metadata) - set(self.metadata):
+        """
+        Add a column for each key that has none, typed from its value.
+        Filters go through here too, so existing columns are left as they are.
+        """
+        if self.client.jsonb_metadata:
+            # any key can be stored in the metadata document
+            return
+        self._add_columns({key: column_type(value) for key, value in metadata.items()})
+        self.metadata.update(metadata)
+
+    def _prepare_columns(self, metadatas):
+        """
+        Make every column able to hold the metadata about to be written. Missing columns
+        are added with a type that holds every value of the batch. Existing columns are
+        never rewritten during a write: values they cannot hold fail before anything is written.
+        """
+        if self.client.jsonb_metadata:
+            return
+        types = metadata_column_types(metadatas)
+        self._add_columns({key: type or "TEXT" for key, type in types.items()})
+
+        def too_narrow():
+            return {
+                key: widened_type(self.types[key], type)
+                for key, type in types.items()
+                if type is not None and widened_type(self.types[key], type) != self.types[key]
+            }
+
+        if too_narrow():
+            # another client may have widened them already
+            self._load_columns()
+            if needed := too_narrow():
+                key, type = next(iter(needed.items()))
+                raise ValueError(
+                    f"Metadata {key} of collection {self.category} is stored as {self.types[key]} "
+                    f"and cannot hold the new values, widen it first with "
+                    f"client.widen_metadata_columns({self.category!r}, {{{key!r}: {type!r}}})"
+                )
+
+    def _add_columns(self, types):
+        columns = self.columns
+        if new_columns := [key for key in types if key not in columns]:
             agentlogger.log(f"Undeclared metadata {', '.join(new_columns)} for collection {self.category}")
-            self.client._ensure_metadata_columns_exist(self.category, metadata)
-            self.metadata.update(metadata)
+            new_types = {key: types[key] for key in new_columns}
+            self.client._ensure_metadata_columns_exist(self.category, new_types)
+            self.columns = columns + new_columns
+            self.types.update(new_types)
+
+    def _metadata_columns(self):
+        if self.client.jsonb_metadata:
+            return ["metadata"]
+        return [col for col in self.columns if col not in reserved_columns]
 
-    def count(self):
+    def _select_columns(self, include):
+        """
+        Columns to fetch for the given include list, so unused data never leaves the database.
+        """
+        columns = ["id"]
+        if "documents" in include:
+            columns.append("document")
+        if "embeddings" in include:
+            columns.append("embedding")
+        if "metadatas" in include:
+            columns.extend(self._metadata_columns())
+        return columns
+
+    def count(self, where=None):
         table_name = self.client._table_name(self.category)
 
-        query = f"SELECT COUNT(*) FROM {table_name}"
-        self.client.cur.execute(query)
+        if where is not None:
+            # count matching rows in the database instead of fetching them
+            self._validate_metadata(parse_metadata(where))
+            conditions, params = parse_conditions(
+                where, types=self.types, **self.client.condition_options
+            )
+            query = f"SELECT COUNT(*) FROM {table_name}"
+            if conditions:
+                query += " WHERE " + " AND ".join(conditions)
+            with self.client.cursor() as cur:
+                cur.execute(query, tuple(params))
+                return cur.fetchone()[0]
+
+        return self._cached_count(lambda: self.client.count_rows(self.category))
+
+    def _batch_count_changes(self):
+        """
+        Count changes made by the current thread's batch, or None outside a batch.
+        They are applied once the batch commits, so other threads never count rows
+        that may still be rolled back.
+        """
+        return getattr(self.client.local, "count_changes", None)
+
+    def _cached_count(self, load):
+        changes = self._batch_count_changes()
+        if changes is None:
+            return super()._cached_count(load)
+        deltas = [delta for collection, delta in changes if collection is self]
+        if self._count is None or None in deltas:
+            # the batch's connection sees its own uncommitted rows, so its count is not cached
+            return load()
+        return self._count + sum(deltas)
+
+    def _adjust_count(self, delta):
+        changes = self._batch_count_changes()
+        if changes is None:
+            super()._adjust_count(delta)
+        else:
+            changes.append((self, delta))
 
-        return self.client.cur.fetchone()[0]
+    def _invalidate_count(self):
+        super()._invalidate_count()
+        changes = self._batch_count_changes()
+        if changes is not None:
+            # a count loaded by another thread before the commit is dropped again after it
+            changes.append((self, None))
 
     def add(self, ids=None, documents=None, metadatas=None, embeddings=None):
         # dropping ids, using database serial
-        embeddings = embeddings or repeat(None)
-        metadatas = metadatas or repeat({})
-        for document, metadata, emb in zip(
-            documents, metadatas, embeddings
-        ):
-            self.client.insert_memory(self.category, document, metadata, emb)
+        return self.client.insert_memories(
+            self.category, documents, metadatas, embeddings
+        )
+
+    def _select_query(self, ids, where, where_document, include, order, after):
+        """
+        SELECT statement, parameters and selected columns shared by get and stream.
+        """
+        table_name = self.client._table_name(self.category)
+        self._validate_metadata(parse_metadata(where))
+        conditions, params = parse_conditions(
+            where, where_document, ids, types=self.types, **self.client.condition_options
+        )
+
+        if order not in (None, "asc", "desc"):
+            raise ValueError(f"Unknown order: {order}")
+
+        if after is not None:
+            # keyset pagination on the primary key
+            conditions.append("id < %s" if order == "desc" else "id > %s")
+            params.append(int(after))
+
+        columns = self._select_columns(include)
+
+        query = f"SELECT {self.client._select_list(columns)} FROM {table_name}"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        if order is not None:
+            query += f" ORDER BY id {order.upper()}"
+        return query, params, columns
+
+    def _to_collection(self, rows, columns, include):
+        output = rows_to_collection(rows, columns, include, jsonb=self.client.jsonb_metadata)
+        # only return the keys that were included
+        return {key: value for key, value in output.items() if value is not None}
 
     def get(
         self,
@@ -136,62 +475,56 @@ class PostgresCollection(CollectionMemory):
         offset=None,
         where_document=None,
         include=["metadatas", "documents"],
+        order=None,
+        after=None,
     ):
-        # TODO: Mirrors Chroma API, but could be optimized a lot
-        category = self.category
-        table_name = self.client._table_name(category)
-        self._validate_metadata(parse_metadata(where))
-        conditions, params = parse_conditions(where, where_document, ids)
-
-        if limit is None:
-            limit = 100  # or another default value
-        if offset is None:
-            offset = 0
-
-        query = f"SELECT * FROM {table_name}"
-        if conditions:
-            query += " WHERE " + " AND ".join(conditions)
+        if include is None:
+            include = ["metadatas", "documents"]
+        query, params, columns = self._select_query(
+            ids, where, where_document, include, order, after
+        )
+        # LIMIT NULL returns every row
         query += " LIMIT %s OFFSET %s"
-        params.extend([limit, offset])
-
-        self.client.cur.execute(query, tuple(params))
+        params.extend([limit, offset or 0])
 
-        rows = self.client.cur.fetchall()
+        with self.client.cursor() as cur:
+            cur.execute(query, tuple(params))
+            rows = cur.fetchall()
 
-        # Convert rows to list of dictionaries
-        columns = [desc[0] for desc in self.client.cur.description]
-        metadata_columns = [
-            col for col in columns if col not in ["id", "document", "embedding"]
-        ]
-
-        result = []
-        for row in rows:
-            item = dict(zip(columns, row))
-            metadata = {col: item[col] for col in metadata_columns}
-            item["metadata"] = metadata
-            result.append(item)
-
-        output = {
-            "ids": [row["id"] for row in result],
-            "documents": [row["document"] for row in result],
-            "metadatas": [row["metadata"] for row in result],
-        }
+        return self._to_collection(rows, columns, include)
 
-        if len(result) == 0 or include is None:
-            return output
-
-        # embeddings is an array, check if include includes "embeddings"
-        if 'embeddings' in include and result[0].get("embedding", None) is not None:
-            output["embeddings"] = [row["embedding"] for row in result]
-            # transform from ndarray to list
-            output["embeddings"] = [emb.tolist() for emb in output["embeddings"]]
-
-        if 'distances' in include and result[0].get("distance", None) is not None:
-            output["distances"] = [row["distances"] for row in result]
-            # transform to list
-            output["distances"] = [dist.tolist() for dist in output["distances"]]
+    def stream(
+        self,
+        where=None,
+        where_document=None,
+        include=["metadatas", "documents"],
+        order="asc",
+        page_size=100,
+    ):
+        """
+        Yield the matching records page_size at a time, in get's format. Only one page
+        is held in memory. Inside a batch the pages are read from a single query through
+        a named server-side cursor on the batch's connection. Otherwise each page is its
+        own keyset query, so no connection is held between pages and the caller's loop
+        can make other memory calls.
+        """
+        # keyset pages need an order, and the primary key order costs nothing
+        order = order or "asc"
+        if getattr(self.client.local, "connection", None) is None:
+            yield from super().stream(where, where_document, include, order, page_size)
+            return
+
+        query, params, columns = self._select_query(
+            None, where, where_document, include, order, None
+        )
 
-        return output
+        with self.client.transaction() as connection:
+            # named cursors only fetch itersize rows per round trip
+            with connection.cursor(name=f"stream_{uuid.uuid4().hex}") as cur:
+                cur.itersize = page_size
+                cur.execute(query, tuple(params))
+                while rows := cur.fetchmany(page_size):
+                    yield self._to_collection(rows, columns, include)
 
     def peek(self, limit=10):
         return self.get(limit=limit)
@@ -206,40 +539,58 @@ class PostgresCollection(CollectionMemory):
         include=["metadatas", "documents", "distances"],
     ):
         return self.client.query(
-            self.category, query_texts, n_results, where, where_document
+            self.category,
+            query_texts,
+            n_results,
+            where,
+            where_document,
+            query_embeddings=query_embeddings,
+            include=include,
         )
 
     def update(self, ids, documents=None, metadatas=None, embeddings=None):
-        # if embeddings is not None
-        if embeddings is None:
-            if documents is None:
-                documents = [None] * len(ids)
-            for id_, document, metadata in zip(ids, documents, metadatas):
-                self.client.update(self.category, id_, document, metadata)
-        else:
-            for id_, document, metadata, emb in zip(
-                ids, documents, metadatas, embeddings
-            ):
-                self.client.update(self.category, id_, document, metadata, emb)
+        self.client.update_memories(self.category, ids, documents, metadatas, embeddings)
 
     def upsert(self, ids, documents=None, metadatas=None, embeddings=None):
-        self.add(ids, documents, metadatas, embeddings)
+        return self.add(ids, documents, metadatas, embeddings)
 
     def delete(self, ids=None, where=None, where_document=None):
         table_name = self.client._table_name(self.category)
-        conditions, params = parse_conditions(where, where_document, ids)
+        conditions, params = parse_conditions(
+            where, where_document, ids, types=self.types, **self.client.condition_options
+        )
 
         if conditions:
             query = f"DELETE FROM {table_name} WHERE " + " AND ".join(conditions)
         else:
             raise Exception("No valid conditions provided for deletion.")
 
-        self.client.cur.execute(query, tuple(params))
-        self.client.connection.commit()
+        with self._count_change():
+            with self.client.cursor() as cur:
+                cur.execute(query, tuple(params))
+                deleted = cur.rowcount
+            self._adjust_count(-deleted)
 
 
 default_model_path = str(Path.home() / ".cache" / "onnx_models")
 
+# distance metric -> (pgvector operator, index operator class)
+distance_operators = {
+    "l2": ("<->", "vector_l2_ops"),
+    "cosine": ("<=>", "vector_cosine_ops"),
+    "ip": ("<#>", "vector_ip_ops"),
+}
+
+# parameters each index type accepts in its WITH clause
+index_parameters = {
+    "hnsw": ("m", "ef_construction"),
+    "ivfflat": ("lists",),
+}
+
+# how embeddings are stored: full float32 vectors, half precision vectors,
+# or full vectors searched through a binary quantized copy and reranked
+vector_storages = ("full", "half", "binary")
+
 
 class PostgresClient(AgentMemory):
     def __init__(
@@ -248,224 +599,732 @@ class PostgresClient(AgentMemory):
         model_name="all-MiniLM-L6-v2",
         model_path=default_model_path,
         embedding_width=384,
+        estimate_counts=False,
+        min_connections=1,
+        max_connections=10,
+        distance="l2",
+        index_type=None,
+        index_params=None,
+        ef_search=None,
+        probes=None,
+        metadata_storage="columns",
+        text_search="like",
+        vector_storage="full",
+        rerank_factor=4,
     ):
-        self.connection = psycopg2.connect(connection_string)
-        self.cur = self.connection.cursor()
-        from pgvector.psycopg2 import register_vector
-
-        register_vector(self.cur)  # Register PGVector functions
+        if distance not in distance_operators:
+            raise ValueError(f"Unknown distance metric: {distance}")
+        if metadata_storage not in ("columns", "jsonb"):
+            raise ValueError(f"Unknown metadata storage: {metadata_storage}")
+        if text_search not in ("like", "trigram", "tokens"):
+            raise ValueError(f"Unknown text search: {text_search}")
+        if vector_storage not in vector_storages:
+            raise ValueError(f"Unknown vector storage: {vector_storage}")
+        # each operation checks out its own connection, so threads can share the client
+        self.pool = ThreadedConnectionPool(
+            min_connections,
+            max_connections,
+            connection_string,
+            connection_factory=VectorConnection,
+        )
+        # the pool raises when it runs dry, so callers wait for a free connection instead
+        self.available_connections = threading.BoundedSemaphore(max_connections)
+        # connection pinned by an open batch, per thread
+        self.local = threading.local()
         full_model_path = check_model(model_name=model_name, model_path=model_path)
         self.model_path = full_model_path
         self.embedding_width = embedding_width
-        self.collections = {}
+        self.estimate_counts = estimate_counts
+        self.collections = CollectionRegistry()
+        self.distance = distance
+        self.index_type = index_type
+        self.index_params = index_params or {}
+        self.ef_search = ef_search
+        self.probes = probes
+        # store metadata in one indexed JSONB column instead of a column per key
+        self.jsonb_metadata = metadata_storage == "jsonb"
+        # like and trigram match substrings, tokens matches whole words
+        self.text_search = text_search
+        self.condition_options = {
+            "jsonb": self.jsonb_metadata,
+            "tokens": text_search == "tokens",
+        }
+        # half and binary storage need pgvector 0.7
+        self.vector_storage = vector_storage
+        # binary storage reranks this many candidates per result with the full vectors
+        self.rerank_factor = rerank_factor
+
+    @contextmanager
+    def transaction(self):
+        """
+        Check out a pooled connection for the duration of a transaction.
+        Commits when the block succeeds and rolls back if it raises.
+        """
+        pinned = getattr(self.local, "connection", None)
+        if pinned is not None:
+            # inside a batch, the batch commits when it ends
+            yield pinned
+            return
+
+        with self.available_connections:
+            connection = self.pool.getconn()
+            try:
+                self._register_vector(connection)
+                yield connection
+                connection.commit()
+            except BaseException:
+                connection.rollback()
+                raise
+            finally:
+                self.pool.putconn(connection)
+
+    @contextmanager
+    def batch(self):
+        """
+        Run every operation of this thread in one transaction, committed when the block ends.
+        Rolls back all of them if the block raises.
+
+        Example:
+        >>> with client.batch():
+        ...     client.insert_memory("events", "first")
+        ...     client.insert_memory("events", "second")
+        """
+        if getattr(self.local, "connection", None) is not None:
+            # nested batches join the outer one
+            yield self
+            return
+
+        self.local.count_changes = []
+        try:
+            with self.transaction() as connection:
+                self.local.connection = connection
+                try:
+                    yield self
+                finally:
+                    self.local.connection = None
+        except BaseException:
+            # cached columns may describe changes that were rolled back
+            self.local.count_changes = None
+            self.collections.invalidate()
+            raise
+
+        changes, self.local.count_changes = self.local.count_changes, None
+        for collection, delta in changes:
+            if delta is None:
+                collection._invalidate_count()
+            else:
+                collection._adjust_count(delta)
+
+    @contextmanager
+    def cursor(self):
+        """
+        Open a fresh cursor in its own transaction.
+        """
+        with self.transaction() as connection:
+            with connection.cursor() as cur:
+                yield cur
+
+    def _register_vector(self, connection):
+        # the vector type is registered once per connection, which only one thread uses at a time
+        if connection.vector_registered:
+            return
+        from pgvector.psycopg2 import register_vector
+
+        register_vector(connection)  # Register PGVector functions
+        connection.vector_registered = True
 
     def _table_name(self, category):
         return f"memory_{category}"
 
     def ensure_table_exists(self, category):
         table_name = self._table_name(category)
-        self.cur.execute(
-            f"""
-            CREATE TABLE IF NOT EXISTS {table_name} (
-                id SERIAL PRIMARY KEY,
-                document TEXT NOT NULL,
-                embedding VECTOR({self.embedding_width})
+        with self.cursor() as cur:
+            # IF NOT EXISTS does not cover two sessions creating the same table at once
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (table_name,))
+            cur.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {table_name} (
+                    id SERIAL PRIMARY KEY,
+                    document TEXT NOT NULL,
+                    embedding {self._vector_type()}({self.embedding_width})
+                )
+            """
             )
+            if self.vector_storage == "binary":
+                # one bit per dimension, kept up to date by the database
+                cur.execute(
+                    f"""
+                    ALTER TABLE {table_name}
+                    ADD COLUMN IF NOT EXISTS embedding_bits BIT({self.embedding_width})
+                    GENERATED ALWAYS AS (binary_quantize(embedding)::bit({self.embedding_width})) STORED
+                """
+                )
+            if self.jsonb_metadata:
+                cur.execute(
+                    f"""
+                    ALTER TABLE {table_name}
+                    ADD COLUMN IF NOT EXISTS metadata JSONB NOT NULL DEFAULT '{{}}'
+                """
+                )
+                cur.execute(
+                    f"""
+                    CREATE INDEX IF NOT EXISTS {table_name}_metadata_idx
+                    ON {table_name} USING GIN (metadata jsonb_path_ops)
+                """
+                )
+            if self.text_search == "trigram":
+                cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+                cur.execute(
+                    f"""
+                    CREATE INDEX IF NOT EXISTS {table_name}_document_trgm_idx
+                    ON {table_name} USING GIN (document gin_trgm_ops)
+                """
+                )
+            elif self.text_search == "tokens":
+                cur.execute(
+                    f"""
+                    ALTER TABLE {table_name}
+                    ADD COLUMN IF NOT EXISTS document_tsv TSVECTOR
+                    GENERATED ALWAYS AS (to_tsvector('{text_search_config}', document)) STORED
+                """
+                )
+                cur.execute(
+                    f"""
+                    CREATE INDEX IF NOT EXISTS {table_name}_document_tsv_idx
+                    ON {table_name} USING GIN (document_tsv)
+                """
+                )
+        # ivfflat trains its lists on the rows present when it is built, so on an empty
+        # table it is left to create_index or rebuild_index once the data is loaded
+        if self.index_type == "hnsw":
+            self.create_index(category, self.index_type, **self.index_params)
+
+    def _index_name(self, category):
+        return f"{self._table_name(category)}_embedding_idx"
+
+    def _vector_type(self):
+        return "HALFVEC" if self.vector_storage == "half" else "VECTOR"
+
+    def _select_list(self, columns):
+        # halfvec values are read back as vectors, which pgvector adapts to numpy
+        if self.vector_storage == "half":
+            columns = ["embedding::vector AS embedding" if col == "embedding" else col for col in columns]
+        return ", ".join(columns)
+
+    def create_index(self, category, index_type=None, **params):
         """
+        Create an approximate nearest neighbor index on the embeddings of a category,
+        using the operator class of the client's distance metric.
+        With binary vector storage the quantized bits are indexed by hamming distance.
+        Does nothing if the category already has an index.
+
+        Arguments:
+        category (str): Category of the collection.
+        index_type (str): "hnsw" or "ivfflat". Defaults to the client's index type, or "hnsw".
+        params: Index parameters, m and ef_construction for hnsw, lists for ivfflat.
+            Default to the client's index parameters for its own index type.
+            lists defaults to one list per thousand rows.
+
+        Example:
+        >>> client.create_index("books", "hnsw", m=16, ef_construction=64)
+        """
+        query = self._create_index_query(category, index_type, params)
+        with self.cursor() as cur:
+            cur.execute(query)
+
+    def _create_index_query(self, category, index_type, params):
+        if index_type is None:
+            index_type = self.index_type or "hnsw"
+        if index_type == self.index_type and not params:
+            params = self.index_params
+        if index_type not in index_parameters:
+            raise ValueError(f"Unknown index type: {index_type}")
+        if unknown := set(params) - set(index_parameters[index_type]):
+            raise ValueError(f"Unknown {index_type} parameters: {', '.join(unknown)}")
+
+        if index_type == "ivfflat" and "lists" not in params:
+            # ivfflat trains its lists on the rows present when it is built
+            params = dict(params, lists=max(self.count_rows(category) // 1000, 1))
+
+        table_name = self._table_name(category)
+        column, operator_class = "embedding", distance_operators[self.distance][1]
+        if self.vector_storage == "half":
+            operator_class = operator_class.replace("vector_", "halfvec_")
+        elif self.vector_storage == "binary":
+            column, operator_class = "embedding_bits", "bit_hamming_ops"
+        with_clause = ", ".join(f"{key} = {int(value)}" for key, value in params.items())
+        query = (
+            f"CREATE INDEX IF NOT EXISTS {self._index_name(category)} "
+            f"ON {table_name} USING {index_type} ({column} {operator_class})"
         )
-        self.connection.commit()
+        if with_clause:
+            query += f" WITH ({with_clause})"
+        return query
 
-    def _ensure_metadata_columns_exist(self, category, metadata):
+    def create_metadata_index(self, category, key, numeric=False):
+        """
+        Create a btree index on a metadata field, for equality, range and $in filters.
+
+        Arguments:
+        category (str): Category of the collection.
+        key (str): Metadata key to index.
+        numeric (bool): With JSONB metadata, index the value as a number for numeric filters.
+
+        Example:
+        >>> client.create_metadata_index("events", "created_at")
+        """
         table_name = self._table_name(category)
-        for key in metadata.keys():
-            self.cur.execute(
+        if self.jsonb_metadata:
+            # the expression must match the one used by metadata_condition
+            literal = key.replace("'", "''")
+            expression = f"(metadata->>'{literal}')"
+            if numeric:
+                expression = numeric_metadata(expression)
+        else:
+            self.get_or_create_collection(category, {key: None})
+            expression = key
+        with self.cursor() as cur:
+            cur.execute(
+                f"CREATE INDEX IF NOT EXISTS {table_name}_{key}_idx ON {table_name} ({expression})"
+            )
+
+    def drop_index(self, category):
+        with self.cursor() as cur:
+            cur.execute(f"DROP INDEX IF EXISTS {self._index_name(category)}")
+
+    def rebuild_index(self, category, index_type=None, **params):
+        """
+        Rebuild the index of a category, for example after a bulk load.
+        Without an index type the existing index is rebuilt with its own parameters,
+        which retrains ivfflat lists on the current rows. Otherwise it is replaced.
+
+        Example:
+        >>> client.rebuild_index("books", "ivfflat", lists=200)
+        """
+        if index_type is None:
+            with self.cursor() as cur:
+                cur.execute(f"REINDEX INDEX {self._index_name(category)}")
+            return
+        query = self._create_index_query(category, index_type, params)
+        # dropped and created in one transaction, so searches never run without an index
+        # and a failed build keeps the old one
+        with self.cursor() as cur:
+            cur.execute(f"DROP INDEX IF EXISTS {self._index_name(category)}")
+            cur.execute(query)
+
+    def table_columns(self, category):
+        """
+        Column names of a category table, in table order.
+        """
+        with self.cursor() as cur:
+            cur.execute(
                 """
-                SELECT EXISTS (
-                    SELECT 1
-                    FROM pg_catalog.pg_attribute
-                    WHERE attrelid = %s::regclass
-                    AND attname = %s
-                    AND NOT attisdropped
-                )
+                SELECT attname
+                FROM pg_catalog.pg_attribute
+                WHERE attrelid = %s::regclass
+                AND attnum > 0
+                AND NOT attisdropped
+                ORDER BY attnum
             """,
-                (table_name, key),
+                (self._table_name(category),),
             )
-            exists = self.cur.fetchone()[0]
-            if not exists:
-                self.cur.execute(f"ALTER TABLE {table_name} ADD COLUMN {key} TEXT")
-                self.connection.commit()
+            return [row[0] for row in cur.fetchall()]
 
-    def list_collections(self):
-        self.cur.execute(
-            "SELECT table_name FROM information_schema.tables WHERE table_schema='public'"
+    def column_types(self, category):
+        """
+        SQL type of each column of a category table, in table order.
+        """
+        with self.cursor() as cur:
+            cur.execute(
+                """
+                SELECT attname, format_type(atttypid, atttypmod)
+                FROM pg_catalog.pg_attribute
+                WHERE attrelid = %s::regclass
+                AND attnum > 0
+                AND NOT attisdropped
+                ORDER BY attnum
+            """,
+                (self._table_name(category),),
+            )
+            return dict(cur.fetchall())
+
+    def count_rows(self, category):
+        table_name = self._table_name(category)
+        with self.cursor() as cur:
+            if self.estimate_counts:
+                # the planner's row estimate avoids scanning the whole table
+                cur.execute(
+                    "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                    (table_name,),
+                )
+                estimate = cur.fetchone()[0]
+                # tables that were never analyzed have no estimate yet, and the estimate
+                # of a small table may predate most of its rows, so those are counted
+                if estimate >= exact_count_threshold:
+                    return estimate
+
+            cur.execute(f"SELECT COUNT(*) FROM {table_name}")
+            return cur.fetchone()[0]
+
+    def _ensure_metadata_columns_exist(self, category, types):
+        # a single statement adds every missing column, IF NOT EXISTS covers columns added concurrently
+        if len(types) == 0:
+            return
+        table_name = self._table_name(category)
+        additions = ", ".join(
+            f"ADD COLUMN IF NOT EXISTS {key} {type}" for key, type in types.items()
         )
+        with self.cursor() as cur:
+            cur.execute(f"ALTER TABLE {table_name} {additions}")
+
+    def widen_metadata_columns(self, category, types):
+        """
+        Change the type of metadata columns so they can hold values of another type.
+        Stored values are converted in place. This rewrites the table under an exclusive
+        lock, so it is never done implicitly by a write.
+
+        Arguments:
+        category (str): Category of the collection.
+        types (dict): SQL type of each column, such as "DOUBLE PRECISION" or "TEXT".
+
+        Example:
+        >>> client.widen_metadata_columns("events", {"score": "DOUBLE PRECISION"})
+        """
+        table_name = self._table_name(category)
+        changes = ", ".join(
+            f"ALTER COLUMN {key} TYPE {type} USING {key}::{type}" for key, type in types.items()
+        )
+        with self.cursor() as cur:
+            cur.execute(f"ALTER TABLE {table_name} {changes}")
+        if collection := self.collections.get(category):
+            # filters send numbers as numbers only to numeric columns
+            collection._load_columns()
+
+    def list_collections(self):
+        with self.cursor() as cur:
+            cur.execute(
+                "SELECT table_name FROM information_schema.tables WHERE table_schema='public'"
+            )
+            rows = cur.fetchall()
         return [
             AgentCollection(name=row[0].split("_")[1])
-            for row in self.cur.fetchall()
+            for row in rows
             if row[0].startswith("memory_")
         ]
 
     def get_collection(self, category, metadata=None):
-        if collection := self.collections.get(category):
-            if metadata:
-                collection._validate_metadata(metadata)
-        else:
-            # Should we check for table existence here?
-            collection = PostgresCollection(category, self, metadata)
-        return collection
+        # Should we check for table existence here?
+        return self.get_or_create_collection(category, metadata)
 
     def delete_collection(self, category):
         table_name = self._table_name(category)
-        self.cur.execute(f"DROP TABLE IF EXISTS {table_name}")
-        self.connection.commit()
-        self.collections.pop(category, None)
+        with self.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {table_name}")
+        self.collections.invalidate(category)
 
     def get_or_create_collection(self, category, metadata=None):
         if collection := self.collections.get(category):
             if metadata:
                 collection._validate_metadata(metadata)
         else:
-            collection = PostgresCollection(category, self, metadata)
+            # the table is only created once per category for the life of the client
+            collection = self.collections.get_or_create(
+                category, lambda: PostgresCollection(category, self, metadata)
+            )
         return collection
 
     def insert_memory(self, category, document, metadata={}, embedding=None, id=None):
-        collection = self.get_or_create_collection(category, metadata)
-        table_name = self._table_name(category)
+        embeddings = None if embedding is None else [embedding]
+        ids = None if id is None else [id]
+        return self.insert_memories(category, [document], [metadata], embeddings, ids)[0]
 
-        if embedding is None:
-            embedding = self.create_embedding(document)
-
-        # Extracting the keys and values from metadata to insert them into respective columns
-        columns = ["document", "embedding"] + list(metadata.keys())
-        placeholders = ["%s"] * len(columns)
-        values = [document, embedding] + list(metadata.values())
+    def insert_memories(
+        self, category, documents, metadatas=None, embeddings=None, ids=None
+    ):
+        """
+        Insert a batch of memories with a single statement in one transaction.
+        Documents without embeddings are embedded together in one pass.
 
-        query = f"""
-        INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join(placeholders)})
-        RETURNING id;
+        Returns:
+        list: The id of each inserted memory, in the order of documents.
         """
-        self.cur.execute(query, tuple(values))
-        self.connection.commit()
-        return self.cur.fetchone()[0]
+        documents = list(documents)
+        if len(documents) == 0:
+            return []
+        metadatas = list(metadatas) if metadatas is not None else [{}] * len(documents)
+
+        # every row gets every metadata column, missing values are null
+        meta_keys = list(metadata_column_types(metadatas))
+        # columns are added or widened to hold every value of the batch
+        collection = self.get_or_create_collection(category)
+        collection._prepare_columns(metadatas)
+        table_name = self._table_name(category)
+
+        if embeddings is None:
+            embeddings = self.create_embeddings(documents)
+
+        if self.jsonb_metadata:
+            columns = ["document", "embedding", "metadata"]
+            rows = [
+                [document, embedding, jsonb_metadata(metadata)]
+                for document, metadata, embedding in zip(documents, metadatas, embeddings)
+            ]
+        else:
+            columns = ["document", "embedding"] + meta_keys
+            rows = [
+                [document, embedding] + [metadata.get(key) for key in meta_keys]
+                for document, metadata, embedding in zip(documents, metadatas, embeddings)
+            ]
+        if ids is not None:
+            columns = ["id"] + columns
+            rows = [[id_] + row for id_, row in zip(ids, rows)]
+
+        query = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES %s RETURNING id"
+        with collection._count_change():
+            with self.cursor() as cur:
+                # fetch=True collects the returned ids across pages, in insertion order
+                inserted_ids = [
+                    row[0]
+                    for row in execute_values(
+                        cur, query, rows, page_size=collection.max_batch_size, fetch=True
+                    )
+                ]
+            collection._adjust_count(len(inserted_ids))
+        return inserted_ids
 
     def create_embedding(self, document):
-        embeddings = infer_embeddings([document], model_path=self.model_path)
+        embeddings = embed_documents([document], model_path=self.model_path)
         return embeddings[0]
 
+    def create_embeddings(self, documents):
+        return embed_documents(list(documents), model_path=self.model_path)
+
     def add(self, category, documents, metadatas, ids):
-        metadatas = list(metadatas)  # in case it's a consumable iterable
-        meta_keys = reduce(set.union, (set(parse_metadata(m)) for m in metadatas), set())
-        collection = self.get_or_create_collection(category, meta_keys)
-        table_name = self._table_name(category)
-        with self.connection.cursor() as cur:
-            for document, metadata, id_ in zip(documents, metadatas, ids):
-                columns = ["id", "document", "embedding"] + list(metadata.keys())
-                placeholders = ["%s"] * len(columns)
-                embedding = self.create_embedding(document)
-                values = [id_, document, embedding] + list(metadata.values())
-
-                query = f"""
-                INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join(placeholders)});
-                """
-                cur.execute(query, tuple(values))
-            self.connection.commit()
+        return self.insert_memories(category, documents, metadatas, ids=ids)
 
     def query(
-        self, category, query_texts, n_results=5, where=None, where_document=None
+        self,
+        category,
+        query_texts=None,
+        n_results=5,
+        where=None,
+        where_document=None,
+        query_embeddings=None,
+        ef_search=None,
+        probes=None,
+        include=["metadatas", "documents", "embeddings", "distances"],
     ):
         collection = self.get_or_create_collection(category, parse_metadata(where))
         table_name = self._table_name(category)
         collection._validate_metadata(parse_metadata(where))
-        conditions, params = parse_conditions(where, where_document)
+        conditions, params = parse_conditions(
+            where, where_document, types=collection.types, **self.condition_options
+        )
 
         where_clause = " WHERE " + " AND ".join(conditions) if conditions else ""
 
-        results = {
-            "ids": [],
-            "documents": [],
-            "metadatas": [],
-            "embeddings": [],
-            "distances": [],
-        }
-        with self.connection.cursor() as cur:
-            for emb in query_texts:
-                query_emb = self.create_embedding(emb)
-                params_with_emb = [query_emb] + params + [query_emb, n_results]
-                string = f"""
-                    SELECT id, document, embedding, embedding <-> %s AS distance, *
-                    FROM {table_name}
+        columns = collection._select_columns(include)
+        results = {key: [] for key in ["ids", "documents", "metadatas", "embeddings", "distances"]}
+        if query_embeddings is None:
+            # embed every query text in one pass
+            query_embeddings = self.create_embeddings(query_texts)
+        else:
+            # pgvector only adapts numpy arrays
+            query_embeddings = [np.asarray(emb, dtype=np.float32) for emb in query_embeddings]
+        operator = distance_operators[self.distance][0]
+        ef_search = ef_search or self.ef_search
+        probes = probes or self.probes
+        with self.cursor() as cur:
+            # recall/latency settings only last for this transaction
+            if ef_search is not None:
+                cur.execute("SELECT set_config('hnsw.ef_search', %s, true)", (str(ef_search),))
+            if probes is not None:
+                cur.execute("SELECT set_config('ivfflat.probes', %s, true)", (str(probes),))
+            if self.vector_storage == "binary":
+                # the nearest bits by hamming distance are reranked with the full vectors
+                source = f"""(
+                    SELECT * FROM {table_name}
                     {where_clause}
-                    ORDER BY embedding <-> %s
+                    ORDER BY embedding_bits <~> binary_quantize(query_embedding)
                     LIMIT %s
-                    """
-                cur.execute(
-                    string,
-                    tuple(params_with_emb),
-                )
-                rows = cur.fetchall()
-                columns = [desc[0] for desc in cur.description]
-                metadata_columns = [
-                    col
-                    for col in columns
-                    if col not in ["id", "document", "embedding", "distance"]
+                ) AS candidates"""
+                where_clause = ""
+                params = params + [
+                    n_results * self.rerank_factor if n_results is not None else None
                 ]
-                for row in rows:
-                    results["ids"].append(row[0])
-                    results["documents"].append(row[1])
-                    results["embeddings"].append(row[2])
-                    results["distances"].append(row[3])
-                    metadata = {
-                        col: row[columns.index(col)] for col in metadata_columns
-                    }
-                    results["metadatas"].append(metadata)
+            else:
+                source = table_name
+            # every query runs in one statement, a lateral join picks the nearest rows of each
+            cur.execute(
+                f"""
+                SELECT query_index, nearest.*
+                FROM unnest(%s::{self._vector_type()}[]) WITH ORDINALITY AS queries(query_embedding, query_index)
+                CROSS JOIN LATERAL (
+                    SELECT {self._select_list(columns)}, embedding {operator} query_embedding AS distance
+                    FROM {source}
+                    {where_clause}
+                    ORDER BY embedding {operator} query_embedding
+                    LIMIT %s
+                ) AS nearest
+                ORDER BY query_index, distance
+                """,
+                tuple([list(query_embeddings)] + params + [n_results]),
+            )
+            rows = cur.fetchall()
+
+        # results are grouped per query, like chroma
+        grouped = [[] for _ in query_embeddings]
+        for row in rows:
+            # the query index comes first and the distance last, around the included columns
+            grouped[row[0] - 1].append(row[1:])
+        for group_rows in grouped:
+            group = rows_to_collection(
+                group_rows,
+                columns,
+                include,
+                distances=[row[-1] for row in group_rows],
+                jsonb=self.jsonb_metadata,
+            )
+            for key in results:
+                results[key].append(group[key])
+
+        # keys that were not included are None, like chroma
+        for key in ["documents", "metadatas", "embeddings", "distances"]:
+            if results[key] and results[key][0] is None:
+                results[key] = None
         return results
 
     def update(self, category, id_, document=None, metadata=None, embedding=None):
-        collection = self.get_or_create_collection(category, parse_metadata(metadata))
+        self.update_memories(
+            category,
+            [id_],
+            [document or None],
+            [metadata or {}],
+            [embedding] if embedding is not None else None,
+        )
+
+    def update_memories(
+        self, category, ids, documents=None, metadatas=None, embeddings=None
+    ):
+        """
+        Update a batch of memories with a single statement.
+        New documents are embedded together in one pass. When only some rows get a
+        document, those are compared with the stored text first, so unchanged ones
+        are not embedded again. None values keep what is stored.
+        """
+        ids = list(ids)
+        if len(ids) == 0:
+            return
+        documents = list(documents) if documents is not None else [None] * len(ids)
+        metadatas = [metadata or {} for metadata in metadatas] if metadatas is not None else [{}] * len(ids)
+        embeddings = list(embeddings) if embeddings is not None else [None] * len(ids)
+
+        meta_keys = list(metadata_column_types(metadatas))
+        collection = self.get_or_create_collection(category)
+        collection._prepare_columns(metadatas)
         table_name = self._table_name(category)
-        with self.connection.cursor() as cur:
-            if document:
-                if embedding is None:
-                    embedding = self.create_embedding(document)
-                if metadata:
-                    columns = ["document=%s", "embedding=%s"] + [
-                        f"{key}=%s" for key in metadata.keys()
-                    ]
-                    values = [document, embedding] + list(metadata.values())
+        # kept up to date by _prepare_columns, so no catalog query is needed
+        types = collection.types
+
+        unembedded = [
+            index
+            for index, (document, embedding) in enumerate(zip(documents, embeddings))
+            if document is not None and embedding is None
+        ]
+        if len(unembedded) == len(ids):
+            # the caller gave new text for every row, looking up the stored text would not pay off
+            embeddings = list(self.create_embeddings(documents))
+        elif unembedded:
+            with self.cursor() as cur:
+                cur.execute(
+                    f"SELECT id, document FROM {table_name} WHERE id = ANY(%s::{types['id']}[])",
+                    ([str(ids[index]) for index in unembedded],),
+                )
+                stored = {str(id_): document for id_, document in cur.fetchall()}
+            changed = []
+            for index in unembedded:
+                if stored.get(str(ids[index])) == documents[index]:
+                    # same text, the stored document and embedding stay
+                    documents[index] = None
                 else:
-                    columns = ["document=%s", "embedding=%s"]
-                    values = [document, embedding]
+                    changed.append(index)
+            if changed:
+                new_embeddings = self.create_embeddings([documents[index] for index in changed])
+                for index, embedding in zip(changed, new_embeddings):
+                    embeddings[index] = embedding
+        # pgvector only adapts numpy arrays
+        embeddings = [
+            None if embedding is None else np.asarray(embedding, dtype=np.float32)
+            for embedding in embeddings
+        ]
 
-                query = f"""
-                UPDATE {table_name}
-                SET {', '.join(columns)}
-                WHERE id=%s
-                """
-                cur.execute(query, tuple(values) + (id_,))
-            elif metadata:
-                collection._validate_metadata(metadata)
-                columns = [f"{key}=%s" for key in metadata.keys()]
-                values = list(metadata.values())
-                query = f"""
-                UPDATE {table_name}
-                SET {', '.join(columns)}
-                WHERE id=%s
-                """
-                cur.execute(query, tuple(values) + (id_,))
-            self.connection.commit()
+        if self.jsonb_metadata:
+            columns = ["document", "embedding", "metadata"]
+            rows = [
+                [str(id_), document, embedding, jsonb_metadata(metadata) if metadata else None]
+                for id_, document, metadata, embedding in zip(ids, documents, metadatas, embeddings)
+            ]
+            # merge the given keys into the stored metadata
+            assignments = ["metadata = t.metadata || COALESCE(v.metadata, '{}')"]
+        else:
+            columns = ["document", "embedding"] + meta_keys
+            rows = [
+                [str(id_), document, embedding] + [metadata.get(key) for key in meta_keys]
+                for id_, document, metadata, embedding in zip(ids, documents, metadatas, embeddings)
+            ]
+            assignments = [f"{key} = COALESCE(v.{key}, t.{key})" for key in meta_keys]
+        assignments = [
+            f"{column} = COALESCE(v.{column}, t.{column})" for column in ("document", "embedding")
+        ] + assignments
+
+        # the values are cast to the column types, so missing values can be null
+        template = "(" + ", ".join(f"%s::{types[column]}" for column in ["id"] + columns) + ")"
+        query = f"""
+        UPDATE {table_name} AS t
+        SET {', '.join(assignments)}
+        FROM (VALUES %s) AS v(id, {', '.join(columns)})
+        WHERE t.id = v.id
+        """
+        with self.cursor() as cur:
+            execute_values(cur, query, rows, template=template, page_size=len(rows))
 
     def close(self):
-        self.cur.close()
-        self.connection.close()
+        self.pool.closeall()
 
 
 def create_client():
     postgres_connection_string = os.environ.get("POSTGRES_CONNECTION_STRING")
     model_name = os.environ.get("POSTGRES_MODEL_NAME", "all-MiniLM-L6-v2")
     embedding_width = os.environ.get("EMBEDDING_WIDTH", 384)
+    estimate_counts = os.environ.get("POSTGRES_ESTIMATE_COUNTS", "false") in ("true", "True")
+    min_connections = int(os.environ.get("POSTGRES_MIN_CONNECTIONS", 1))
+    max_connections = int(os.environ.get("POSTGRES_MAX_CONNECTIONS", 10))
+    distance = os.environ.get("POSTGRES_DISTANCE", "l2")
+    index_type = os.environ.get("POSTGRES_INDEX_TYPE")
+    ef_search = os.environ.get("POSTGRES_HNSW_EF_SEARCH")
+    probes = os.environ.get("POSTGRES_IVFFLAT_PROBES")
+    metadata_storage = os.environ.get("POSTGRES_METADATA_STORAGE", "columns")
+    text_search = os.environ.get("POSTGRES_TEXT_SEARCH", "like")
+    vector_storage = os.environ.get("POSTGRES_VECTOR_STORAGE", "full")
+    rerank_factor = int(os.environ.get("POSTGRES_RERANK_FACTOR", 4))
     if postgres_connection_string is None:
         raise EnvironmentError(
             "Postgres connection string not set in environment variables!"
         )
-    return PostgresClient(postgres_connection_string, model_name=model_name, embedding_width=embedding_width)
+    return PostgresClient(
+        postgres_connection_string,
+        model_name=model_name,
+        embedding_width=embedding_width,
+        estimate_counts=estimate_counts,
+        min_connections=min_connections,
+        max_connections=max_connections,
+        distance=distance,
+        index_type=index_type,
+        ef_search=int(ef_search) if ef_search else None,
+        probes=int(probes) if probes else None,
+        metadata_storage=metadata_storage,
+        text_search=text_search,
+        vector_storage=vector_storage,
+        rerank_factor=rerank_factor,
+    )
 
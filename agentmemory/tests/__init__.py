@@ -3,4 +3,7 @@ from .main import *
 from .persistence import *
 from .events import *
 from .clustering import *
-from .check_model import *
\ No newline at end of file
+from .check_model import *
+from .embedding_cache import *
+from .postgres import *
+from .aio import *
\ No newline at end of file
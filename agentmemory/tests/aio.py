@@ -0,0 +1,43 @@
+import asyncio
+
+from agentmemory import count_memories, get_memories, wipe_category
+from agentmemory import aio
+
+
+def test_aio_memory_operations():
+    wipe_category("test")
+
+    async def scenario():
+        # concurrent coroutines share the executor
+        await asyncio.gather(
+            *(aio.create_memory("test", "async memory " + str(i)) for i in range(10))
+        )
+        memories = await aio.get_memories("test", n_results=20)
+        assert len(memories) == 10
+
+        results = await aio.search_memory("test", "async memory 3", n_results=1)
+        assert results[0]["document"] == "async memory 3"
+
+        memory_id = results[0]["id"]
+        await aio.update_memory("test", memory_id, metadata={"seen": "yes"})
+        await aio.delete_memory("test", memories[0]["id"])
+        return await aio.run(count_memories, "test")
+
+    assert asyncio.run(scenario()) == 9
+    wipe_category("test")
+
+
+def test_aio_create_memory_leaves_metadata_alone():
+    wipe_category("test")
+    metadata = {"mood": "calm"}
+
+    async def scenario():
+        await aio.create_memory("test", "first memory", metadata=metadata)
+        await aio.create_memory("test", "second memory")
+
+    asyncio.run(scenario())
+    assert metadata == {"mood": "calm"}
+    memories = get_memories("test", sort_order="asc")
+    assert memories[0]["metadata"]["mood"] == "calm"
+    assert memories[1]["metadata"].get("mood") is None
+    wipe_category("test")
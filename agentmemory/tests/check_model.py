@@ -2,7 +2,14 @@ import os
 from pathlib import Path
 import shutil
 import tempfile
-from agentmemory.check_model import check_model, infer_embeddings
+from concurrent.futures import ThreadPoolExecutor
+from agentmemory.check_model import (
+    EmbeddingEngine,
+    EmbeddingScheduler,
+    check_model,
+    embed_documents,
+    infer_embeddings,
+)
 
 def test_check_model():
     model_name = "all-MiniLM-L6-v2"
@@ -37,4 +44,136 @@ def test_infer_embeddings():
     # Validate the result
     assert isinstance(embeddings, np.ndarray), "Output must be a numpy array"
     assert embeddings.shape[0] == len(documents), "Number of embeddings must match number of input documents"
-    assert embeddings.shape[1] > 0, "Embedding size must be greater than 0"
\ No newline at end of file
+    assert embeddings.shape[1] > 0, "Embedding size must be greater than 0"
+
+def test_embedding_engine_reuses_session():
+    model_path = check_model()
+    engine = EmbeddingEngine()
+
+    engine.warmup(model_path)
+    model = engine.load(model_path)
+
+    # The same tokenizer and session are returned on every call
+    assert engine.load(model_path) is model
+
+    first = infer_embeddings(["A sentence."], model_path, engine=engine)
+    second = infer_embeddings(["A sentence."], model_path, engine=engine)
+    assert np.allclose(first, second)
+    assert engine.load(model_path) is model
+
+
+def test_embedding_engine_persists_optimized_model():
+    model_path = check_model()
+    optimized_path = os.path.join(model_path, "model.optimized.onnx")
+    if os.path.exists(optimized_path):
+        os.remove(optimized_path)
+
+    expected = infer_embeddings(["A sentence."], model_path, engine=EmbeddingEngine())
+
+    # The first load writes the optimized graph, the second one reads it back
+    EmbeddingEngine(persist_optimized=True).warmup(model_path)
+    assert os.path.exists(optimized_path)
+    embeddings = infer_embeddings(
+        ["A sentence."], model_path, engine=EmbeddingEngine(persist_optimized=True)
+    )
+    assert np.allclose(embeddings, expected, atol=1e-5)
+
+    os.remove(optimized_path)
+
+
+def test_infer_embeddings_dynamic_padding():
+    model_path = check_model()
+
+    # Mixed lengths so the documents get reordered into buckets
+    documents = [
+        "A fairly long sentence about agents, memories and embeddings.",
+        "Short.",
+        "A medium length sentence.",
+        "",
+        "Another short one.",
+    ]
+
+    fixed = infer_embeddings(documents, model_path, batch_size=2, padding="max_length")
+    dynamic = infer_embeddings(documents, model_path, batch_size=2)
+
+    # Dynamic padding returns the same embeddings, in input order
+    assert dynamic.shape == fixed.shape
+    assert np.allclose(dynamic, fixed, atol=1e-5)
+
+    single = infer_embeddings([documents[1]], model_path)
+    assert np.allclose(dynamic[1], single[0], atol=1e-5)
+
+    assert infer_embeddings([], model_path).shape[0] == 0
+
+
+def test_embedding_scheduler_batches_concurrent_requests():
+    model_path = check_model()
+    engine = EmbeddingEngine(cache_path=None)
+    scheduler = EmbeddingScheduler(model_path, max_batch_size=32, max_wait=0.05, engine=engine)
+    documents = ["sentence number " + str(i) for i in range(16)]
+
+    # every caller gets back its own rows, although the requests share model runs
+    futures = [scheduler.submit([document]) for document in documents]
+    futures.append(scheduler.submit([]))
+    embeddings = [future.result() for future in futures]
+    expected = infer_embeddings(documents, model_path, engine=engine)
+    for embedding, row in zip(embeddings, expected):
+        assert np.allclose(embedding, row[np.newaxis], atol=1e-5)
+    assert embeddings[-1].shape[0] == 0
+    assert scheduler.batches < len(documents)
+
+
+def test_embed_documents_uses_the_scheduler():
+    model_path = check_model()
+    engine = EmbeddingEngine(cache_path=None, schedule=True, schedule_max_wait=0.01)
+    documents = ["sentence number " + str(i) for i in range(8)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        embeddings = list(
+            executor.map(lambda document: embed_documents([document], model_path, engine), documents)
+        )
+    expected = infer_embeddings(documents, model_path, engine=engine)
+    assert np.allclose(np.concatenate(embeddings), expected, atol=1e-5)
+    assert engine.get_scheduler(model_path).batches < len(documents)
+    assert EmbeddingEngine(schedule=False).get_scheduler(model_path) is None
+
+
+def test_embedding_scheduler_survives_cancelled_requests():
+    model_path = check_model()
+    engine = EmbeddingEngine(cache_path=None)
+    scheduler = EmbeddingScheduler(model_path, max_wait=0.2, engine=engine)
+
+    # a request cancelled while it waits for its batch is dropped, the rest of the batch runs
+    cancelled = scheduler.submit(["cancelled sentence"])
+    assert cancelled.cancel()
+    embedding = scheduler.submit(["kept sentence"]).result(timeout=30)
+    assert np.allclose(embedding, infer_embeddings(["kept sentence"], model_path, engine=engine), atol=1e-5)
+
+    # a failing batch fails its callers only
+    failing = EmbeddingScheduler(model_path + "_missing", max_wait=0, engine=engine)
+    for _ in range(2):
+        try:
+            failing.embed(["sentence"])
+            assert False, "a missing model should fail"
+        except Exception:
+            pass
+    assert failing.worker.is_alive()
+
+
+def test_embedding_scheduler_after_fork():
+    if not hasattr(os, "fork"):
+        return
+    model_path = check_model()
+    engine = EmbeddingEngine(cache_path=None)
+    scheduler = EmbeddingScheduler(model_path, engine=engine)
+    expected = scheduler.embed(["sentence before the fork"])
+
+    # the worker thread is not copied into the child, which starts its own
+    pid = os.fork()
+    if pid == 0:
+        try:
+            future = scheduler.submit(["sentence before the fork"])
+            os._exit(0 if np.allclose(future.result(timeout=30), expected, atol=1e-5) else 1)
+        except BaseException:
+            os._exit(1)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
@@ -1,4 +1,5 @@
 from agentmemory import cluster, create_memory, get_memories, wipe_category
+from agentmemory import clustering
 
 # Sample data
 memories_data = [
@@ -120,3 +121,25 @@ def test_cluster_expansion():
     clusters = {memory["metadata"].get("cluster") for memory in memories_data}
     assert len(clusters) == 2
     wipe_category("fruits")
+
+
+def test_cluster_writes_labels_in_chunks():
+    wipe_category("fruits")
+    for document in ["apple", "apple", "apple", "banana", "banana", "banana", "car"]:
+        create_memory("fruits", document)
+
+    # labels are written every two memories, a label written early can still be replaced
+    label_batch_size = clustering.label_batch_size
+    clustering.label_batch_size = 2
+    try:
+        cluster(epsilon=0.5, min_samples=2, category="fruits")
+    finally:
+        clustering.label_batch_size = label_batch_size
+
+    clusters = {}
+    for memory in get_memories("fruits"):
+        clusters.setdefault(memory["document"], set()).add(memory["metadata"].get("cluster"))
+    assert all(len(labels) == 1 for labels in clusters.values())
+    assert clusters["car"] == {"noise"}
+    assert len(clusters["apple"] | clusters["banana"]) == 2
+    wipe_category("fruits")
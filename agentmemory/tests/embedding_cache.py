@@ -0,0 +1,183 @@
+import multiprocessing
+import shutil
+import tempfile
+
+import numpy as np
+import pytest
+
+from agentmemory.check_model import EmbeddingEngine, check_model, infer_embeddings
+from agentmemory.embedding_cache import EmbeddingCache, QueryEmbeddingCache, fcntl
+
+
+def _vectors(count, dimensions=4):
+    return np.arange(count * dimensions, dtype=np.float32).reshape(count, dimensions)
+
+
+def test_embedding_cache_get_and_put():
+    temp_dir = tempfile.mkdtemp()
+    cache = EmbeddingCache(temp_dir, model_name="test-model")
+
+    assert cache.get_many(["a", "b"]) == [None, None]
+    assert cache.misses == 2
+
+    cache.put_many(["a", "b"], _vectors(2))
+    a, b, c = cache.get_many(["a", "b", "c"])
+    assert np.array_equal(a, _vectors(2)[0])
+    assert np.array_equal(b, _vectors(2)[1])
+    assert c is None
+    assert cache.hits == 2
+    assert len(cache) == 2
+
+    shutil.rmtree(temp_dir)
+
+
+def test_embedding_cache_evicts_least_recently_used():
+    temp_dir = tempfile.mkdtemp()
+    # room for three 4-dimensional float32 vectors
+    cache = EmbeddingCache(temp_dir, model_name="test-model", max_bytes=3 * 4 * 4)
+
+    cache.put_many(["a", "b", "c"], _vectors(3))
+    # touch "a" so "b" becomes the least recently used entry
+    cache.get_many(["a"])
+    cache.put_many(["d"], _vectors(1) + 100)
+
+    a, b, c, d = cache.get_many(["a", "b", "c", "d"])
+    assert b is None
+    assert np.array_equal(a, _vectors(3)[0])
+    assert np.array_equal(d, _vectors(1)[0] + 100)
+    assert len(cache) == 3
+
+    shutil.rmtree(temp_dir)
+
+
+def test_embedding_cache_persists():
+    temp_dir = tempfile.mkdtemp()
+    cache = EmbeddingCache(temp_dir, model_name="test-model")
+    cache.put_many(["a", "b"], _vectors(2))
+    cache.flush()
+
+    reopened = EmbeddingCache(temp_dir, model_name="test-model")
+    a, b = reopened.get_many(["a", "b"])
+    assert np.array_equal(a, _vectors(2)[0])
+    assert np.array_equal(b, _vectors(2)[1])
+
+    # a smaller budget keeps the most recently used entries
+    shrunk = EmbeddingCache(temp_dir, model_name="test-model", max_bytes=4 * 4)
+    assert shrunk.get_many(["a"]) == [None]
+    assert np.array_equal(shrunk.get_many(["b"])[0], _vectors(2)[1])
+
+    # other models don't share entries
+    other = EmbeddingCache(temp_dir, model_name="other-model")
+    assert other.get_many(["a"]) == [None]
+
+    shutil.rmtree(temp_dir)
+
+
+def test_embedding_cache_ignores_stale_index():
+    temp_dir = tempfile.mkdtemp()
+    cache = EmbeddingCache(temp_dir, model_name="test-model", max_bytes=4 * 4)
+    cache.put_many(["a"], _vectors(1))
+    cache.flush()
+
+    # "b" takes over the only slot, but the index on disk still points "a" at it
+    cache.put_many(["b"], _vectors(1) + 1)
+    cache.vectors.flush()
+    cache.keys.flush()
+
+    reopened = EmbeddingCache(temp_dir, model_name="test-model", max_bytes=4 * 4)
+    assert reopened.get_many(["a"]) == [None]
+
+    shutil.rmtree(temp_dir)
+
+
+def _share_cache(path, seed, errors):
+    # every text has its own vector, a hit with another text's vector is an error
+    rng = np.random.default_rng(seed)
+    cache = EmbeddingCache(path, model_name="test-model", max_bytes=8 * 4 * 4, flush_every=4)
+    for _ in range(200):
+        numbers = rng.integers(0, 32, size=3)
+        cache.put_many([str(n) for n in numbers], np.repeat(numbers[:, None], 4, axis=1))
+        for number, embedding in zip(numbers, cache.get_many([str(n) for n in numbers])):
+            if embedding is not None and not np.all(embedding == number):
+                errors.put(int(number))
+    cache.flush()
+
+
+@pytest.mark.skipif(fcntl is None, reason="requires file locks")
+def test_embedding_cache_shared_between_processes():
+    temp_dir = tempfile.mkdtemp()
+    context = multiprocessing.get_context("fork")
+    errors = context.Queue()
+    processes = [
+        context.Process(target=_share_cache, args=(temp_dir, seed, errors)) for seed in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    assert all(process.exitcode == 0 for process in processes)
+    assert errors.empty()
+    reopened = EmbeddingCache(temp_dir, model_name="test-model", max_bytes=8 * 4 * 4)
+    for number in range(32):
+        embedding = reopened.get_many([str(number)])[0]
+        assert embedding is None or np.all(embedding == number)
+
+    shutil.rmtree(temp_dir)
+
+
+def test_infer_embeddings_uses_cache():
+    temp_dir = tempfile.mkdtemp()
+    model_path = check_model()
+    engine = EmbeddingEngine(cache_path=temp_dir)
+    documents = ["This is a test sentence.", "Another test sentence."]
+
+    expected = infer_embeddings(documents, model_path, use_cache=False)
+    first = infer_embeddings(documents, model_path, engine=engine)
+    second = infer_embeddings(documents + ["A new sentence."], model_path, engine=engine)
+
+    cache = engine.get_cache(model_path)
+    assert cache.hits == 2
+    assert cache.misses == 3
+    assert np.allclose(first, expected, atol=1e-6)
+    assert np.allclose(second[:2], expected, atol=1e-6)
+    assert second.shape[0] == 3
+
+    shutil.rmtree(temp_dir)
+
+
+def test_query_embedding_cache():
+    calls = []
+
+    def embed(texts):
+        calls.append(list(texts))
+        return _vectors(len(texts))
+
+    cache = QueryEmbeddingCache(max_size=2)
+    embeddings = cache.get_many(["a", "b", "a"], embed)
+    assert embeddings.shape == (3, 4)
+    # duplicated texts are embedded once
+    assert calls == [["a", "b"]]
+    assert np.array_equal(embeddings[0], embeddings[2])
+
+    cache.get_many(["b"], embed)
+    assert cache.hits == 1
+    assert len(calls) == 1
+
+    # "a" is the least recently used entry and is evicted
+    cache.get_many(["c"], embed)
+    assert len(cache) == 2
+    cache.get_many(["a"], embed)
+    assert calls[-1] == ["a"]
+
+
+def test_query_embedding_cache_is_dropped_for_another_model():
+    cache = QueryEmbeddingCache()
+    first_model, second_model = object(), object()
+
+    first = cache.get_many(["a"], lambda texts: _vectors(len(texts)), model=first_model)
+    second = cache.get_many(["a"], lambda texts: _vectors(len(texts)) + 100, model=second_model)
+    assert cache.misses == 2
+    assert not np.array_equal(first, second)
+    assert np.array_equal(cache.get_many(["a"], None, model=second_model), second)
+    assert len(cache) == 1
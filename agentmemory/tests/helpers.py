@@ -5,11 +5,17 @@ import pytest
 from agentmemory import (
     chroma_collection_to_list,
     create_memory,
+    create_memories,
     get_client,
     list_to_chroma_collection,
     wipe_all_memories,
 )
-from agentmemory.helpers import flatten_arrays, get_include_types
+from agentmemory.helpers import (
+    flatten_arrays,
+    get_include_types,
+    get_metadata_filter,
+    split_query_results,
+)
 from agentmemory.persistence import (
     export_memory_to_file,
     export_memory_to_json,
@@ -71,6 +77,36 @@ def test_flatten_arrays():
     assert flattened["ids"] == ["id1", "id2"], "Flatten ids failed"
 
 
+def test_split_query_results():
+    test_dict = {
+        "metadatas": [["metadata1", "metadata2"], ["metadata3"]],
+        "documents": [["document1", "document2"], ["document3"]],
+        "ids": [["id1", "id2"], ["id3"]],
+        "embeddings": None,
+    }
+    groups = split_query_results(test_dict)
+    assert len(groups) == 2, "There should be one group per query"
+    assert groups[0]["ids"] == ["id1", "id2"], "Split ids failed"
+    assert groups[1]["documents"] == ["document3"], "Split documents failed"
+    assert groups[1]["embeddings"] is None, "Missing embeddings should stay missing"
+    assert "distances" not in groups[0], "Absent keys should not be added"
+
+
+def test_get_metadata_filter():
+    assert get_metadata_filter() is None
+    assert get_metadata_filter({"test": "test"}) == {"test": "test"}
+    assert get_metadata_filter(novel=True) == {"novel": "True"}
+
+    where = get_metadata_filter({"test": "test", "count": {"$gt": 1}}, novel=True)
+    assert where == {
+        "$and": [
+            {"test": {"$eq": "test"}},
+            {"count": {"$gt": 1}},
+            {"novel": {"$eq": "True"}},
+        ]
+    }, "Multiple fields should be combined with $and"
+
+
 def test_get_include_types():
     include_types = get_include_types(True, False)
     assert include_types == [
@@ -115,6 +151,14 @@ def test_export_memory_to_json():
     assert len(data) == 0, "No collections should exist"
 
 
+def test_export_memory_to_json_exports_every_memory():
+    wipe_all_memories()
+    create_memories("test", ["document " + str(i) for i in range(50)])
+    data = export_memory_to_json(include_embeddings=False)
+    assert len(data["test"]) == 50
+    wipe_all_memories()
+
+
 def test_export_memory_to_file():
     # Test with default parameters
     export_memory_to_file()
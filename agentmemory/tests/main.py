@@ -1,17 +1,33 @@
+import copy
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from agentmemory import (
     search_memory,
+    search_memories,
+    search_memory_by_embedding,
+    search_similar_to,
     get_memory,
     create_memory,
+    create_memories,
     get_memories,
+    iter_memories,
     update_memory,
+    update_memories,
     delete_memory,
     count_memories,
     wipe_category,
     wipe_all_memories,
     delete_memories,
+    transaction,
+)
+from agentmemory import client as client_module
+from agentmemory.client import CollectionRegistry, get_client
+from agentmemory.main import (
+    create_unique_memory,
+    delete_similar_memories,
+    query_embedding_cache,
 )
-from agentmemory.main import create_unique_memory, delete_similar_memories
 
 
 def test_memory_creation_and_retrieval():
@@ -34,6 +50,118 @@ def test_memory_creation_and_retrieval():
     wipe_category("test")
 
 
+def test_get_memories_sort_order():
+    wipe_category("test")
+    create_memories("test", ["document " + str(i) for i in range(30)])
+
+    memories = get_memories("test", n_results=5, include_embeddings=False)
+    assert [m["document"] for m in memories] == ["document " + str(i) for i in range(29, 24, -1)]
+    assert "embedding" not in memories[0]
+
+    memories = get_memories("test", sort_order="asc", n_results=3)
+    assert [m["document"] for m in memories] == ["document 0", "document 1", "document 2"]
+    wipe_category("test")
+
+
+def test_iter_memories():
+    wipe_category("test")
+    create_memories(
+        "test",
+        ["document " + str(i) for i in range(25)],
+        metadatas=[{"even": str(i % 2 == 0)} for i in range(25)],
+    )
+
+    memories = list(iter_memories("test", page_size=10))
+    assert [m["document"] for m in memories] == ["document " + str(i) for i in range(25)]
+
+    memories = list(
+        iter_memories("test", page_size=4, sort_order="desc", filter_metadata={"even": "True"})
+    )
+    assert [m["document"] for m in memories] == ["document " + str(i) for i in range(24, -1, -2)]
+
+    # the backend's own order still yields every memory once
+    memories = list(iter_memories("test", page_size=10, sort_order=None, include_embeddings=False))
+    assert sorted(m["document"] for m in memories) == sorted("document " + str(i) for i in range(25))
+
+    assert list(iter_memories("empty_category")) == []
+    wipe_category("test")
+    wipe_category("empty_category")
+
+
+def test_create_memories():
+    wipe_category("test")
+    texts = ["document " + str(i) for i in range(10)]
+    metadatas = [{"test": "test", "index": str(i), "flag": i % 2 == 0} for i in range(10)]
+
+    # small batch size so the memories are sent in several chunks
+    ids = create_memories("test", texts, metadatas=metadatas, batch_size=3)
+
+    assert count_memories("test") == 10
+
+    memories = get_memories("test", n_results=10)
+    # the generated ids are returned in the order of the texts
+    assert ids == [memory["id"] for memory in reversed(memories)]
+    assert len(set(ids)) == 10
+    assert memories[0]["document"] == "document 9"
+    assert memories[-1]["document"] == "document 0"
+    assert memories[0]["metadata"]["flag"] == "False"
+    assert memories[0]["metadata"]["created_at"] == memories[-1]["metadata"]["created_at"]
+
+    # the caller's metadata is left untouched
+    assert "created_at" not in metadatas[0]
+    wipe_category("test")
+
+
+def test_create_memories_with_different_metadata_keys():
+    wipe_category("test")
+    create_memories(
+        "test",
+        ["document 1", "document 2"],
+        metadatas=[{"speaker": "HAL"}, {"mood": "calm"}],
+    )
+
+    first, second = get_memories("test", sort_order="asc")
+    assert first["metadata"]["speaker"] == "HAL"
+    assert first["metadata"].get("mood") is None
+    assert second["metadata"]["mood"] == "calm"
+    wipe_category("test")
+
+
+def test_create_memories_from_threads():
+    wipe_category("test")
+
+    def create(thread):
+        for i in range(5):
+            create_memory("test", f"thread {thread} document {i}")
+        return search_memory("test", f"thread {thread}", n_results=1)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(create, range(4)))
+
+    assert all(len(result) == 1 for result in results)
+    assert count_memories("test") == 20
+    wipe_category("test")
+
+
+def test_get_memories_with_range_and_set_filters():
+    wipe_category("test")
+    create_memories(
+        "test",
+        ["document " + str(i) for i in range(5)],
+        metadatas=[{"turn": i, "speaker": "HAL" if i % 2 else "Dave"} for i in range(5)],
+    )
+
+    recent = get_memories("test", filter_metadata={"turn": {"$gte": 3}}, sort_order="asc")
+    assert [memory["document"] for memory in recent] == ["document 3", "document 4"]
+    assert len(get_memories("test", filter_metadata={"turn": {"$lte": 1}})) == 2
+    assert len(get_memories("test", filter_metadata={"turn": {"$in": [0, 4]}})) == 2
+
+    # memories created in the last hour, compared as numbers
+    hour_ago = time.time() - 3600
+    assert len(get_memories("test", filter_metadata={"created_at": {"$gte": hour_ago}})) == 5
+    wipe_category("test")
+
+
 def test_memory_deletion():
     wipe_category("test")
     # Delete memory test
@@ -89,6 +217,87 @@ def test_search_memory():
     wipe_category("test")
 
 
+def test_search_memories():
+    wipe_category("test")
+    for i in range(5):
+        create_memory("test", "document " + str(i + 1), metadata={"test": "test"})
+
+    search_results = search_memories(
+        "test",
+        ["document 1", "document 3"],
+        n_results=2,
+        filter_metadata={"test": "test"},
+    )
+
+    # one group of results per search text, in the same order
+    assert len(search_results) == 2
+    assert len(search_results[0]) == 2
+    assert search_results[0][0]["document"] == "document 1"
+    assert search_results[1][0]["document"] == "document 3"
+
+    assert search_memories("test", []) == []
+    wipe_category("test")
+
+
+def test_search_memory_without_embeddings():
+    wipe_category("test")
+    create_memory("test", "document 1")
+
+    search_results = search_memory("test", "document 1", include_embeddings=False, max_distance=0.5)
+    assert len(search_results) == 1
+    assert "embedding" not in search_results[0]
+    assert "distance" in search_results[0]
+    wipe_category("test")
+
+
+def test_search_memory_by_embedding():
+    wipe_category("test")
+    for i in range(3):
+        create_memory("test", "document " + str(i + 1), id=str(i + 1))
+
+    memory = get_memory("test", "1")
+    search_results = search_memory_by_embedding("test", memory["embedding"], n_results=2)
+    assert len(search_results) == 2
+    assert str(search_results[0]["id"]) == "1"
+    assert search_results[0]["distance"] < 0.001
+    wipe_category("test")
+
+
+def test_search_similar_to():
+    wipe_category("test")
+    for i in range(3):
+        create_memory("test", "document " + str(i + 1), id=str(i + 1))
+
+    search_results = search_similar_to("test", "1", n_results=2)
+    assert len(search_results) == 2
+    assert "1" not in [str(result["id"]) for result in search_results]
+
+    assert search_similar_to("test", "4") == []
+    wipe_category("test")
+
+
+def test_search_memory_reuses_query_embeddings():
+    wipe_category("test")
+    create_memory("test", "document 1")
+    query_embedding_cache.clear()
+
+    first = search_memory("test", "document 1")
+    second = search_memory("test", "document 1")
+    assert query_embedding_cache.misses == 1
+    assert query_embedding_cache.hits == 1
+    assert first[0]["document"] == second[0]["document"] == "document 1"
+
+    # embeddings from one client are not reused by the next
+    client = client_module.client
+    client_module.client = copy.copy(client)
+    try:
+        search_memory("test", "document 1")
+    finally:
+        client_module.client = client
+    assert query_embedding_cache.misses == 2
+    wipe_category("test")
+
+
 def test_wipe_category():
     # test wipe_category
     wipe_category("test")
@@ -99,6 +308,43 @@ def test_wipe_category():
     assert count_memories("test") == 0
 
 
+def test_collection_handles_are_cached():
+    wipe_category("test")
+    collection = get_client().get_or_create_collection("test")
+    assert get_client().get_or_create_collection("test") is collection
+
+    # wiping the category drops the cached handle
+    create_memory("test", "document 1")
+    wipe_category("test")
+    assert get_client().get_or_create_collection("test") is not collection
+    assert count_memories("test") == 0
+
+    create_memory("test", "document 1")
+    wipe_all_memories()
+    assert count_memories("test") == 0
+
+
+def test_collection_registry_builds_handles_outside_its_lock():
+    registry = CollectionRegistry()
+    building = threading.Event()
+    release = threading.Event()
+
+    def slow_factory():
+        building.set()
+        release.wait(10)
+        return "slow"
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        slow = executor.submit(registry.get_or_create, "slow", slow_factory)
+        building.wait(10)
+        # a slow handle does not hold up other categories
+        assert registry.get_or_create("fast", lambda: "fast") == "fast"
+        release.set()
+        assert slow.result() == "slow"
+    # the handle published first is kept
+    assert registry.get_or_create("fast", lambda: "other") == "fast"
+
+
 def test_count_memories():
     wipe_category("test")
     for i in range(3):
@@ -107,6 +353,24 @@ def test_count_memories():
     wipe_category("test")
 
 
+def test_count_memories_cache():
+    wipe_category("test")
+    create_memory("test", "document 1", metadata={"novel": "True"})
+    create_memory("test", "document 2", metadata={"novel": "False"})
+    create_memory("test", "document 3", metadata={"novel": "True"})
+
+    assert count_memories("test") == 3
+    assert count_memories("test", novel=True) == 2
+
+    # the cached count follows adds and deletes
+    create_memories("test", ["document 4", "document 5"])
+    assert count_memories("test") == 5
+    delete_memories("test", metadata={"novel": "False"})
+    assert count_memories("test") == 4
+    assert count_memories("test", novel=True) == 2
+    wipe_category("test")
+
+
 def test_delete_memories():
     wipe_category("books")
     # create a memory to be deleted
@@ -185,4 +449,116 @@ def test_create_unique_memory():
     memories = get_memories("test")
     assert len(memories) == 3
     assert memories[0]["metadata"]["novel"] == "True"
-    wipe_category("test")
\ No newline at end of file
+    wipe_category("test")
+
+def test_transaction():
+    wipe_category("test")
+    with transaction():
+        for i in range(5):
+            create_memory("test", "transaction memory " + str(i))
+        # writes in the block are visible to reads in the block
+        assert count_memories("test") == 5
+        ids = create_memories("test", ["transaction memory 5", "transaction memory 6"])
+    assert count_memories("test") == 7
+    memories = get_memories("test")
+    assert len(memories) == 7
+    # ids are returned even when the writes were buffered until the end of the block
+    assert ids == [memory["id"] for memory in memories[1::-1]]
+    wipe_category("test")
+
+
+def test_transaction_rolls_back_on_error():
+    wipe_category("test")
+    create_memory("test", "kept memory")
+    try:
+        with transaction():
+            create_memory("test", "dropped memory 1")
+            create_memory("test", "dropped memory 2")
+            raise RuntimeError("abort")
+    except RuntimeError:
+        pass
+    memories = get_memories("test")
+    assert [memory["document"] for memory in memories] == ["kept memory"]
+    assert count_memories("test") == 1
+    wipe_category("test")
+
+
+def test_update_memories():
+    wipe_category("test")
+    create_memories(
+        "test",
+        ["doc 1", "doc 2", "doc 3"],
+        metadatas=[{"shelf": "a"}, {"shelf": "a"}, {"shelf": "a"}],
+    )
+    before = {memory["document"]: memory for memory in get_memories("test", include_embeddings=True)}
+    ids = [before[document]["id"] for document in ("doc 1", "doc 2", "doc 3")]
+
+    update_memories(
+        "test",
+        ids,
+        texts=["doc 1 updated", None, "doc 3"],
+        metadatas=[{"shelf": "b"}, {"shelf": "c"}, {}],
+    )
+
+    after = {memory["id"]: memory for memory in get_memories("test", include_embeddings=True)}
+    assert [after[id]["document"] for id in ids] == ["doc 1 updated", "doc 2", "doc 3"]
+    assert [after[id]["metadata"]["shelf"] for id in ids] == ["b", "c", "a"]
+    assert list(after[ids[1]]["embedding"]) == list(before["doc 2"]["embedding"])
+    assert list(after[ids[0]]["embedding"]) != list(before["doc 1"]["embedding"])
+    wipe_category("test")
+
+
+def test_transaction_and_concurrent_writes_get_distinct_ids():
+    wipe_category("test")
+    create_memory("test", "first memory")
+
+    def write_in_transaction():
+        with transaction():
+            for i in range(10):
+                create_memory("test", "batched memory " + str(i))
+                time.sleep(0.001)
+
+    def write_directly():
+        for i in range(10):
+            create_memory("test", "direct memory " + str(i))
+            time.sleep(0.001)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(write_in_transaction), executor.submit(write_directly)]
+        for future in futures:
+            future.result()
+
+    # no memory overwrote another
+    documents = {memory["document"] for memory in get_memories("test", n_results=100)}
+    assert len(documents) == 21
+    assert count_memories("test") == 21
+    wipe_category("test")
+
+
+def test_generated_ids_follow_writes_from_other_clients():
+    wipe_category("test")
+    create_memory("test", "first memory")
+    assert count_memories("test") == 1
+    collection = get_client().get_or_create_collection("test")
+    if not hasattr(collection, "collection"):
+        # Postgres ids come from a sequence
+        wipe_category("test")
+        return
+    # another process writing to the same Chroma directory, behind the cached count
+    collection.collection.add(ids=["0000000000000001"], documents=["written elsewhere"])
+    create_memory("test", "second memory")
+    documents = {memory["document"] for memory in get_memories("test")}
+    assert documents == {"first memory", "written elsewhere", "second memory"}
+    wipe_category("test")
+
+
+def test_generated_ids_skip_ids_that_are_still_stored():
+    wipe_category("test")
+    ids = create_memories("test", ["doc 0", "doc 1", "doc 2"])
+    delete_memory("test", ids[1])
+    # a fresh handle, as after a restart, knows nothing of the ids it generated before
+    get_client().collections.invalidate("test")
+    create_memory("test", "doc 3")
+    memories = get_memories("test")
+    assert [memory["document"] for memory in memories] == ["doc 3", "doc 2", "doc 0"]
+    wipe_category("test")
@@ -0,0 +1,530 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from agentmemory import cluster, create_memories, get_client, get_memories, search_memory, update_memory, wipe_category
+from agentmemory import client as client_module
+from agentmemory.postgres import PostgresClient, column_type, parse_conditions, widened_type
+
+_postgres_only = pytest.mark.skipif(
+    not isinstance(get_client(), PostgresClient), reason="requires the Postgres client"
+)
+
+
+def _index_definition(client, category):
+    with client.cursor() as cur:
+        cur.execute(
+            "SELECT indexdef FROM pg_indexes WHERE indexname = %s",
+            (client._index_name(category),),
+        )
+        row = cur.fetchone()
+    return row[0] if row else None
+
+
+@_postgres_only
+def test_create_and_rebuild_index():
+    client = get_client()
+    wipe_category("test")
+    create_memories("test", ["document " + str(i) for i in range(20)])
+
+    client.create_index("test", "hnsw", m=8, ef_construction=32)
+    definition = _index_definition(client, "test")
+    assert "hnsw" in definition
+    operator_classes = {"full": "vector_l2_ops", "half": "halfvec_l2_ops", "binary": "bit_hamming_ops"}
+    assert operator_classes[client.vector_storage] in definition
+
+    # the index is used transparently by searches
+    assert search_memory("test", "document 1", n_results=3)[0]["document"] == "document 1"
+
+    client.rebuild_index("test", "ivfflat", lists=2)
+    assert "ivfflat" in _index_definition(client, "test")
+    client.rebuild_index("test")
+
+    # a replacement that fails to build keeps the old index
+    with pytest.raises(Exception):
+        client.rebuild_index("test", "ivfflat", lists=0)
+    assert "ivfflat" in _index_definition(client, "test")
+
+    client.drop_index("test")
+    assert _index_definition(client, "test") is None
+    wipe_category("test")
+
+
+@_postgres_only
+def test_ivfflat_index_waits_for_data():
+    client = PostgresClient(os.environ["POSTGRES_CONNECTION_STRING"], index_type="ivfflat")
+    client.delete_collection("ivfflat_test")
+
+    # lists trained on an empty table would be useless, so none is built with the table
+    collection = client.get_or_create_collection("ivfflat_test")
+    assert _index_definition(client, "ivfflat_test") is None
+
+    collection.add(documents=["document " + str(i) for i in range(20)])
+    client.create_index("ivfflat_test")
+    definition = _index_definition(client, "ivfflat_test")
+    assert "ivfflat" in definition
+    assert "lists='1'" in definition
+    client.delete_collection("ivfflat_test")
+    client.close()
+
+
+@_postgres_only
+def test_create_index_rejects_unknown_parameters():
+    with pytest.raises(ValueError):
+        get_client().create_index("test", "hnsw", lists=10)
+    with pytest.raises(ValueError):
+        get_client().create_index("test", "btree")
+
+
+@_postgres_only
+def test_query_with_ef_search_and_probes():
+    client = get_client()
+    wipe_category("test")
+    create_memories("test", ["document " + str(i) for i in range(5)])
+
+    results = client.query("test", ["document 2"], n_results=2, ef_search=10, probes=3)
+    assert results["documents"][0][0] == "document 2"
+    wipe_category("test")
+
+
+@_postgres_only
+def test_get_and_query_only_fetch_included_columns():
+    wipe_category("test")
+    create_memories("test", ["document 1", "document 2"], metadatas=[{"speaker": "HAL"}] * 2)
+    collection = get_client().get_or_create_collection("test")
+
+    memories = collection.get(include=["documents"])
+    assert memories["documents"] == ["document 1", "document 2"]
+    assert "embeddings" not in memories
+    assert "metadatas" not in memories
+
+    results = collection.query(
+        query_texts=["document 1"], n_results=1, include=["metadatas", "distances"]
+    )
+    assert results["embeddings"] is None
+    assert results["documents"] is None
+    assert results["metadatas"][0][0]["speaker"] == "HAL"
+    assert len(results["distances"][0]) == 1
+    wipe_category("test")
+
+
+@_postgres_only
+def test_metadata_columns_are_cached():
+    client = get_client()
+    if client.jsonb_metadata:
+        pytest.skip("metadata is stored in a JSONB column")
+    wipe_category("test")
+    create_memories("test", ["document 1"], metadatas=[{"speaker": "HAL"}])
+    collection = client.get_or_create_collection("test")
+    assert "speaker" in collection.columns
+
+    # later writes check the cached columns instead of the catalog
+    table_columns, column_types = client.table_columns, client.column_types
+    client.table_columns = client.column_types = None
+    try:
+        create_memories("test", ["document 2"], metadatas=[{"speaker": "HAL", "mood": "calm", "tone": "flat"}])
+    finally:
+        client.table_columns, client.column_types = table_columns, column_types
+
+    assert collection.columns[-2:] == ["mood", "tone"]
+    assert client.table_columns("test") == collection.columns
+
+    # updates use the cached column types too, and text given for every row is embedded
+    # without reading the stored text first
+    memories = collection.get()
+    embedded = []
+    table_columns, column_types = client.table_columns, client.column_types
+    create_embeddings = client.create_embeddings
+    client.table_columns = client.column_types = None
+    client.create_embeddings = lambda documents: embedded.append(documents) or create_embeddings(documents)
+    try:
+        update_memory("test", memories["ids"][0], text="document 1", metadata={"mood": "tense"})
+        client.update_memories("test", memories["ids"], ["document 1", "document 3"], [{"turn": 1}, {}])
+    finally:
+        client.table_columns, client.column_types = table_columns, column_types
+        del client.create_embeddings
+    assert embedded == [["document 1"], ["document 1", "document 3"]]
+    assert client.column_types("test")["turn"] == "bigint"
+    assert collection.get(ids=[memories["ids"][0]])["metadatas"][0]["mood"] == "tense"
+    wipe_category("test")
+
+
+def test_parse_conditions():
+    where = {"$and": [{"speaker": {"$eq": "HAL"}}, {"$or": [{"mood": "calm"}, {"turn": {"$gt": "3"}}]}]}
+
+    conditions, params = parse_conditions(where)
+    assert conditions == ["speaker = %s", "(mood = %s) OR (turn > %s)"]
+    assert params == ["HAL", "calm", "3"]
+
+    conditions, params = parse_conditions(where, jsonb=True)
+    assert conditions == ["metadata @> %s", "(metadata @> %s) OR (metadata->>%s > %s)"]
+    assert [param.adapted for param in (params[0], params[1])] == [{"speaker": "HAL"}, {"mood": "calm"}]
+    assert params[2:] == ["turn", "3"]
+
+    conditions, params = parse_conditions(where_document={"$contains": "cat"}, tokens=True)
+    assert conditions == ["document_tsv @@ plainto_tsquery('simple', %s)"]
+    assert params == ["cat"]
+
+
+def test_column_type():
+    assert column_type(True) == "BOOLEAN"
+    assert column_type(3) == "BIGINT"
+    assert column_type(0.5) == "DOUBLE PRECISION"
+    assert column_type("3") == "TEXT"
+    assert column_type(None) == "TEXT"
+    # filters are typed from their operands
+    assert column_type({"$in": [1, 2]}) == "BIGINT"
+    # mixed values widen to a type that holds both
+    assert widened_type("BIGINT", "DOUBLE PRECISION") == "DOUBLE PRECISION"
+    assert widened_type("DOUBLE PRECISION", "BIGINT") == "DOUBLE PRECISION"
+    assert widened_type("BOOLEAN", "BIGINT") == "TEXT"
+    assert widened_type("TEXT", "BIGINT") == "TEXT"
+
+
+@_postgres_only
+def test_jsonb_metadata_storage():
+    client = PostgresClient(os.environ["POSTGRES_CONNECTION_STRING"], metadata_storage="jsonb")
+    client.delete_collection("jsonb_test")
+    collection = client.get_or_create_collection("jsonb_test")
+    collection.add(
+        documents=["document 1", "document 2", "document 3"],
+        metadatas=[{"speaker": "HAL", "turn": 1}, {"speaker": "Dave", "turn": 2}, {}],
+    )
+
+    # new keys do not add columns
+    assert client.table_columns("jsonb_test") == ["id", "document", "embedding", "metadata"]
+
+    memories = collection.get(where={"speaker": "HAL"})
+    assert memories["documents"] == ["document 1"]
+    assert memories["metadatas"] == [{"speaker": "HAL", "turn": "1"}]
+    assert collection.count(where={"turn": {"$gt": "1"}}) == 1
+    # numbers are compared numerically even though they are stored as text
+    assert collection.count(where={"turn": {"$gte": 1}}) == 2
+    assert collection.count(where={"turn": {"$in": [2, 3]}}) == 1
+    assert collection.count(where={"speaker": {"$nin": ["HAL"]}}) == 1
+    assert collection.count(where={"$or": [{"speaker": "HAL"}, {"speaker": "Dave"}]}) == 2
+
+    # values that are not numbers do not fail numeric filters
+    collection.add(documents=["document 4"], metadatas=[{"turn": "last"}])
+    assert collection.count(where={"turn": {"$gte": 1}}) == 2
+    client.create_metadata_index("jsonb_test", "turn", numeric=True)
+    assert collection.count(where={"turn": {"$lt": 2}}) == 1
+
+    client.update("jsonb_test", memories["ids"][0], metadata={"mood": "calm"})
+    assert collection.get(ids=memories["ids"])["metadatas"][0]["mood"] == "calm"
+
+    client.delete_collection("jsonb_test")
+    client.close()
+
+
+@_postgres_only
+def test_token_text_search():
+    client = PostgresClient(os.environ["POSTGRES_CONNECTION_STRING"], text_search="tokens")
+    client.delete_collection("tokens_test")
+    collection = client.get_or_create_collection("tokens_test")
+    collection.add(documents=["the cat sat", "concatenate strings", "a black cat"])
+
+    # whole words match, substrings of other words do not
+    memories = collection.get(where_document={"$contains": "cat"})
+    assert memories["documents"] == ["the cat sat", "a black cat"]
+    assert collection.count(where={"$contains": "black cat"}) == 1
+
+    # the generated column is not returned as metadata
+    assert "document_tsv" not in collection.get()["metadatas"][0]
+
+    collection.delete(where_document={"$contains": "cat"})
+    assert collection.count() == 1
+    client.delete_collection("tokens_test")
+    client.close()
+
+
+@_postgres_only
+def test_typed_metadata_columns_and_index():
+    client = get_client()
+    if client.jsonb_metadata:
+        pytest.skip("metadata is stored in a JSONB column")
+    wipe_category("test")
+    create_memories(
+        "test",
+        ["document 1", "document 2"],
+        metadatas=[{"turn": 1, "score": 0.5, "speaker": "HAL"}, {"turn": 12}],
+    )
+
+    with client.cursor() as cur:
+        cur.execute(
+            "SELECT column_name, data_type FROM information_schema.columns WHERE table_name = %s",
+            ("memory_test",),
+        )
+        types = dict(cur.fetchall())
+    assert types["turn"] == "bigint"
+    assert types["score"] == "double precision"
+    assert types["speaker"] == "text"
+
+    # numbers compare numerically, not as text
+    collection = client.get_or_create_collection("test")
+    assert collection.count(where={"turn": {"$gt": 2}}) == 1
+    assert collection.count(where={"turn": {"$nin": [1, 5]}}) == 1
+    assert collection.count(where={"turn": {"$in": []}}) == 0
+
+    client.create_metadata_index("test", "turn")
+    with client.cursor() as cur:
+        cur.execute("SELECT indexdef FROM pg_indexes WHERE indexname = 'memory_test_turn_idx'")
+        assert "btree (turn)" in cur.fetchone()[0]
+    wipe_category("test")
+
+
+@_postgres_only
+def test_metadata_column_types_are_kept_on_writes():
+    client = get_client()
+    if client.jsonb_metadata:
+        pytest.skip("metadata is stored in a JSONB column")
+    wipe_category("test")
+    create_memories("test", ["document 1", "document 2"], metadatas=[{"turn": 1}, {"turn": 3}])
+    collection = client.get_or_create_collection("test")
+
+    # float operands compare exactly with an integer column
+    assert collection.count(where={"turn": {"$gt": 1.5}}) == 1
+    assert collection.count(where={"turn": {"$in": [1.0, 2.5]}}) == 1
+    assert collection.count(where={"turn": 3.0}) == 1
+    assert len(search_memory("test", "document", n_results=5, filter_metadata={"turn": {"$lte": 2.5}})) == 1
+
+    # a write never rewrites the table, values a column cannot hold fail before anything is written
+    with pytest.raises(ValueError):
+        create_memories("test", ["document 3", "document 4"], metadatas=[{"turn": 4}, {"turn": 2.5}])
+    memories = collection.get()
+    with pytest.raises(ValueError):
+        update_memory("test", memories["ids"][0], metadata={"turn": "first"})
+    assert collection.count() == 2
+    assert client.column_types("test")["turn"] == "bigint"
+
+    # a new column holds every value of the batch that adds it
+    create_memories("test", ["document 3", "document 4"], metadatas=[{"level": 1}, {"level": "high"}])
+    assert client.column_types("test")["level"] == "text"
+
+    # columns are widened explicitly
+    client.widen_metadata_columns("test", {"turn": "DOUBLE PRECISION"})
+    create_memories("test", ["document 5"], metadatas=[{"turn": 2.5}])
+    assert client.column_types("test")["turn"] == "double precision"
+    assert collection.count(where={"turn": {"$gt": 2}}) == 2
+    wipe_category("test")
+
+
+@_postgres_only
+def test_stream_uses_server_side_cursor():
+    client = get_client()
+    wipe_category("test")
+    create_memories("test", ["document " + str(i) for i in range(10)])
+    collection = client.get_or_create_collection("test")
+
+    # outside a batch every page is its own query, no connection is held between pages
+    pages = collection.stream(include=["documents"], page_size=3)
+    assert next(pages)["documents"] == ["document 0", "document 1", "document 2"]
+    assert client.available_connections.acquire(blocking=False)
+    client.available_connections.release()
+    with client.cursor() as cur:
+        cur.execute("SELECT count(*) FROM pg_cursors WHERE name LIKE 'stream_%'")
+        assert cur.fetchone()[0] == 0
+    assert [len(page["ids"]) for page in pages] == [3, 3, 1]
+
+    # in a batch the stream shares the connection, so its cursor is visible
+    with client.batch():
+        pages = collection.stream(include=["documents"], page_size=3)
+        first = next(pages)
+        assert first["documents"] == ["document 0", "document 1", "document 2"]
+        with client.cursor() as cur:
+            cur.execute("SELECT count(*) FROM pg_cursors WHERE name LIKE 'stream_%'")
+            assert cur.fetchone()[0] == 1
+        rest = list(pages)
+    assert [len(page["ids"]) for page in rest] == [3, 3, 1]
+    assert "metadatas" not in first
+    wipe_category("test")
+
+
+@_postgres_only
+def test_query_runs_every_query_in_one_statement():
+    client = get_client()
+    wipe_category("test")
+    create_memories(
+        "test",
+        ["document " + str(i) for i in range(10)],
+        metadatas=[{"parity": str(i % 2)} for i in range(10)],
+    )
+    texts = ["document 1", "document 4", "document 7"]
+    where = {"parity": "1"}
+
+    batched = client.query("test", texts, n_results=3, where=where)
+    assert len(batched["ids"]) == 3
+    for index, text in enumerate(texts):
+        single = client.query("test", [text], n_results=3, where=where)
+        assert batched["ids"][index] == single["ids"][0]
+        assert batched["distances"][index] == single["distances"][0]
+        assert all(metadata["parity"] == "1" for metadata in batched["metadatas"][index])
+
+    assert client.query("test", [], n_results=3)["ids"] == []
+    wipe_category("test")
+
+
+def _supports_quantization():
+    client = get_client()
+    if not isinstance(client, PostgresClient):
+        return False
+    with client.cursor() as cur:
+        cur.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+        version = tuple(int(part) for part in cur.fetchone()[0].split(".")[:2])
+    return version >= (0, 7)
+
+
+def test_vector_storage_is_validated():
+    with pytest.raises(ValueError):
+        PostgresClient(os.environ.get("POSTGRES_CONNECTION_STRING"), vector_storage="quarter")
+
+
+@pytest.mark.parametrize("vector_storage", ["half", "binary"])
+def test_reduced_precision_vector_storage(vector_storage):
+    if not _supports_quantization():
+        pytest.skip("requires Postgres with pgvector 0.7 or later")
+    client = PostgresClient(os.environ["POSTGRES_CONNECTION_STRING"], vector_storage=vector_storage)
+    full_client = PostgresClient(os.environ["POSTGRES_CONNECTION_STRING"])
+    category, full_category = vector_storage + "_test", "full_test"
+    documents = ["document " + str(i) for i in range(20)]
+    metadatas = [{"parity": i % 2} for i in range(20)]
+    for each, each_category in ((client, category), (full_client, full_category)):
+        each.delete_collection(each_category)
+        each.insert_memories(each_category, documents, metadatas=metadatas)
+    client.create_index(category, "hnsw")
+    definition = _index_definition(client, category)
+    assert ("bit_hamming_ops" if vector_storage == "binary" else "halfvec_l2_ops") in definition
+
+    queries = ["document 3", "document 12"]
+    results = client.query(category, queries, n_results=3)
+    assert [group[0] for group in results["documents"]] == queries
+    expected = full_client.query(full_category, queries, n_results=None)
+    for index, group in enumerate(results["distances"]):
+        assert group == sorted(group)
+        exact = dict(zip(expected["documents"][index], expected["distances"][index]))
+        exact = [exact[document] for document in results["documents"][index]]
+        if vector_storage == "binary":
+            # candidates are reranked with the full vectors, so the distances are exact
+            assert group == pytest.approx(exact, abs=1e-6)
+        else:
+            assert group == pytest.approx(exact, abs=1e-2)
+
+    if vector_storage == "binary":
+        # with enough candidates to cover every row, the rerank finds the exact neighbors
+        client.rerank_factor = 20
+        reranked = client.query(category, queries, n_results=3)
+        assert reranked["ids"] == full_client.query(full_category, queries, n_results=3)["ids"]
+        # a single candidate per result still returns full results, nearest first
+        client.rerank_factor = 1
+        reranked = client.query(category, ["document 3"], n_results=3)
+        assert len(reranked["ids"][0]) == 3
+        assert reranked["distances"][0] == sorted(reranked["distances"][0])
+    # embeddings come back as full precision lists
+    embedding = results["embeddings"][0][0]
+    assert len(embedding) == client.embedding_width
+    assert isinstance(embedding[0], float)
+
+    # filters apply before the candidates are picked, and every row is reranked without a limit
+    filtered = client.query(category, ["document 3"], n_results=3, where={"parity": 1})
+    assert filtered["documents"][0][0] == "document 3"
+    assert all(metadata["parity"] == 1 for metadata in filtered["metadatas"][0])
+    assert len(client.query(category, ["document 3"], n_results=None)["ids"][0]) == 20
+
+    # updated text is embedded again and stored in the same format
+    client.update(category, results["ids"][0][0], document="a different text")
+    assert client.query(category, ["a different text"], n_results=1)["documents"][0] == ["a different text"]
+
+    collection = client.get_or_create_collection(category)
+    assert "embedding_bits" not in collection.get(limit=1)["metadatas"][0]
+    client.delete_collection(category)
+    full_client.delete_collection(full_category)
+    client.close()
+    full_client.close()
+
+
+@_postgres_only
+def test_estimated_counts_fall_back_to_exact_counts():
+    client = get_client()
+    wipe_category("test")
+    collection = client.get_or_create_collection("test")
+    with client.cursor() as cur:
+        # the estimate of a table analyzed while empty stays 0 after inserts
+        cur.execute(f"ANALYZE {client._table_name('test')}")
+    client.estimate_counts = True
+    try:
+        create_memories("test", ["document " + str(i) for i in range(5)])
+        collection._invalidate_count()
+        assert collection.count() == 5
+        assert len(search_memory("test", "document 1", n_results=3)) == 3
+        assert len(search_memory("test", "document 1", n_results=float("inf"))) == 5
+    finally:
+        client.estimate_counts = False
+    wipe_category("test")
+
+
+@_postgres_only
+def test_replaced_pool_connections_register_the_vector_type():
+    client = PostgresClient(
+        os.environ["POSTGRES_CONNECTION_STRING"], min_connections=1, max_connections=3
+    )
+    client.delete_collection("pool_test")
+    client.insert_memories("pool_test", ["document 1", "document 2"])
+    for _ in range(3):
+        # connections above min_connections are closed when they are returned
+        with client.transaction() as first, client.transaction() as second:
+            assert first.vector_registered and second.vector_registered
+        with client.transaction(), client.transaction():
+            memories = client.get_or_create_collection("pool_test").get(include=["embeddings"])
+            assert all(isinstance(embedding, list) for embedding in memories["embeddings"])
+    client.delete_collection("pool_test")
+    client.close()
+
+
+@_postgres_only
+def test_cluster_with_a_single_pool_connection():
+    client = PostgresClient(os.environ["POSTGRES_CONNECTION_STRING"], max_connections=1)
+    shared_client = client_module.client
+    client_module.client = client
+    try:
+        wipe_category("pool_test")
+        create_memories("pool_test", ["apple", "apple pie", "banana", "banana bread", "car"])
+
+        # the searches of the loop must not wait for the connection held by the stream
+        worker = threading.Thread(target=cluster, args=(0.5, 1, "pool_test"), daemon=True)
+        worker.start()
+        worker.join(timeout=60)
+        assert not worker.is_alive()
+        assert all("cluster" in memory["metadata"] for memory in get_memories("pool_test"))
+        wipe_category("pool_test")
+    finally:
+        client_module.client = shared_client
+        client.close()
+
+
+@_postgres_only
+def test_batch_counts_apply_on_commit():
+    client = get_client()
+    wipe_category("test")
+    create_memories("test", ["document 0"])
+    collection = client.get_or_create_collection("test")
+    assert collection.count() == 1
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        with client.batch():
+            client.insert_memories("test", ["document 1", "document 2"])
+            # the batch counts its own rows, other threads only count committed ones
+            assert collection.count() == 3
+            assert executor.submit(collection.count).result() == 1
+        assert executor.submit(collection.count).result() == 3
+
+    try:
+        with client.batch():
+            client.insert_memories("test", ["dropped 1", "dropped 2"])
+            raise RuntimeError("abort")
+    except RuntimeError:
+        pass
+    assert client.get_or_create_collection("test").count() == 3
+    assert collection.count() == 3
+    wipe_category("test")
@@ -0,0 +1,60 @@
+"""
+Compare embedding throughput with fixed 256 token padding against dynamic,
+length-bucketed padding.
+
+Usage:
+    python -m benchmarks.embeddings --documents 2000 --batch-size 32
+"""
+import argparse
+import random
+import time
+
+from agentmemory.check_model import check_model, get_embedding_engine, infer_embeddings
+
+WORDS = (
+    "the agent remembered that the user asked about the weather in paris and "
+    "decided to search for recent errors before updating its current goal"
+).split()
+
+
+def make_documents(count, min_words, max_words, seed=0):
+    rng = random.Random(seed)
+    return [
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words)))
+        for _ in range(count)
+    ]
+
+
+def run(documents, model_path, batch_size, padding, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        infer_embeddings(documents, model_path, batch_size=batch_size, padding=padding)
+        best = min(best, time.perf_counter() - start)
+    return len(documents) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--documents", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--min-words", type=int, default=5)
+    parser.add_argument("--max-words", type=int, default=30)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    model_path = check_model()
+    get_embedding_engine().warmup(model_path)
+    documents = make_documents(args.documents, args.min_words, args.max_words)
+
+    fixed = run(documents, model_path, args.batch_size, "max_length", args.repeat)
+    dynamic = run(documents, model_path, args.batch_size, "longest", args.repeat)
+
+    print(f"documents: {len(documents)}, batch size: {args.batch_size}")
+    print(f"fixed 256 padding:  {fixed:10.1f} docs/s")
+    print(f"dynamic padding:    {dynamic:10.1f} docs/s")
+    print(f"speedup:            {dynamic / fixed:10.2f}x")
+
+
+if __name__ == "__main__":
+    main()
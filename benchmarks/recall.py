@@ -0,0 +1,103 @@
+"""
+Compare recall and latency of full, half precision and binary quantized
+vector storage on Postgres, against exact nearest neighbors computed in numpy.
+
+Needs pgvector 0.7 or later for half and binary storage.
+
+Usage:
+    POSTGRES_CONNECTION_STRING=... python -m benchmarks.recall --memories 20000 --queries 200
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+from agentmemory.postgres import PostgresClient
+
+
+def make_embeddings(count, width, clusters, seed=0):
+    # clustered unit vectors look more like sentence embeddings than uniform noise
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, width))
+    embeddings = centers[rng.integers(clusters, size=count)] + rng.normal(scale=0.5, size=(count, width))
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings.astype(np.float32)
+
+
+def exact_neighbors(embeddings, queries, k):
+    # for unit vectors the smallest l2 distances are the largest dot products
+    return np.argsort(-(queries @ embeddings.T), axis=1)[:, :k]
+
+
+def run(connection_string, vector_storage, embeddings, queries, expected, args):
+    client = PostgresClient(
+        connection_string,
+        vector_storage=vector_storage,
+        rerank_factor=args.rerank_factor,
+        ef_search=args.ef_search,
+    )
+    category = f"recall_{vector_storage}"
+    client.delete_collection(category)
+    ids = []
+    for start in range(0, len(embeddings), 1000):
+        batch = embeddings[start:start + 1000]
+        ids += client.insert_memories(
+            category, ["memory"] * len(batch), embeddings=list(batch)
+        )
+    position = {id_: index for index, id_ in enumerate(ids)}
+
+    start = time.perf_counter()
+    client.create_index(category, "hnsw")
+    build = time.perf_counter() - start
+
+    with client.cursor() as cur:
+        cur.execute("SELECT pg_relation_size(%s)", (client._index_name(category),))
+        index_size = cur.fetchone()[0]
+
+    hits = 0
+    start = time.perf_counter()
+    for query, neighbors in zip(queries, expected):
+        results = client.query(
+            category, query_embeddings=[query], n_results=args.k, include=[]
+        )
+        found = {position[id_] for id_ in results["ids"][0]}
+        hits += len(found & set(neighbors))
+    latency = (time.perf_counter() - start) / len(queries)
+
+    client.delete_collection(category)
+    client.close()
+    return hits / expected.size, latency, build, index_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--memories", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--width", type=int, default=384)
+    parser.add_argument("--clusters", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--rerank-factor", type=int, default=4)
+    parser.add_argument("--ef-search", type=int, default=100)
+    parser.add_argument("--storage", nargs="+", default=["full", "half", "binary"])
+    args = parser.parse_args()
+
+    connection_string = os.environ["POSTGRES_CONNECTION_STRING"]
+    embeddings = make_embeddings(args.memories, args.width, args.clusters)
+    queries = make_embeddings(args.queries, args.width, args.clusters, seed=1)
+    expected = exact_neighbors(embeddings, queries, args.k)
+
+    print(f"memories: {args.memories}, queries: {args.queries}, k: {args.k}")
+    print(f"{'storage':8} {'recall':>8} {'query ms':>10} {'build s':>9} {'index MB':>10}")
+    for vector_storage in args.storage:
+        recall, latency, build, index_size = run(
+            connection_string, vector_storage, embeddings, queries, expected, args
+        )
+        print(
+            f"{vector_storage:8} {recall:8.3f} {latency * 1000:10.2f} "
+            f"{build:9.1f} {index_size / 2**20:10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()